@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+"""Suggests which input sections to move into ITCM, DTCM or QUADSPI
+
+The candidates are the `.text.*` and `.rodata.*` input sections that the map
+file places in internal FLASH. Hot code goes to ITCM and hot constants to
+DTCM, packed by expected gain per byte. Cold sections go to QUADSPI to free
+internal FLASH. The result is printed together with linker script snippets
+for APP_STM32F746BGTx_FLASH.ld.
+"""
+
+from __future__ import print_function
+
+import os
+import argparse
+from collections import namedtuple
+
+from analyze_map import MapFile, split_source
+
+
+ITCM_ORIGIN = 0x00000000
+ITCM_SIZE = 16 * 1024
+DTCM_ORIGIN = 0x20000000
+DTCM_SIZE = 64 * 1024
+
+# Share of a hot function's samples handed to the symbols its object references (cref has no finer call graph)
+CALLEE_SHARE = 0.5
+
+# Without a profile, constants referenced from more files than this stay in internal flash
+COLD_FAN_IN = 1
+
+# Objects that run before QUADSPI is memory mapped and the TCMs are copied, or that must not stall on QUADSPI
+INTERNAL_OBJECTS = (
+    'app_startup_stm32f746xx.o',
+    'boot_startup_stm32f746xx.o',
+    'system_stm32f7xx.o',
+    'stm32f7xx_it.o',
+    'stm32f7xx_hal_msp.o',
+    'stm32f7xx_hal_timebase_tim.o',
+    'stm32f7xx_hal.o',
+    'stm32f7xx_hal_cortex.o',
+    'stm32f7xx_hal_gpio.o',
+    'stm32f7xx_hal_rcc.o',
+    'stm32f7xx_hal_rcc_ex.o',
+    'stm32f7xx_hal_qspi.o',
+    'stm32746g_discovery_qspi.o',
+)
+
+Candidate = namedtuple('Candidate', 'section source size names heat')
+
+
+def collect_candidates(map_file_path):
+    """Parse the map file, returning it with the FLASH resident .text.*/.rodata.* input sections"""
+    sections = []
+    def listener(input_section):
+        if input_section.region != 'FLASH' or input_section.load_region is not None:
+            return
+        if not input_section.section.startswith(('.text.', '.rodata.')):
+            return
+        names = set(name for address, name in input_section.symbols)
+        names.add(input_section.section.split('.', 2)[2])  # -ffunction-sections names it after the function
+        sections.append((input_section.section, input_section.source, input_section.size, names))
+    map_file = MapFile(map_file_path, listener=listener)
+    return map_file, sections
+
+
+def read_profile(path):
+    """Read `function [samples]` or `samples function` lines, a bare name counts as one sample"""
+    samples = {}
+    with open(path) as f:
+        for line in f:
+            pieces = line.split('#', 1)[0].split()
+            if not pieces:
+                continue
+            count = 1
+            names = []
+            for piece in pieces:
+                try:
+                    count = float(piece)
+                except ValueError:
+                    names.append(piece)
+            for name in names:
+                samples[name] = samples.get(name, 0) + count
+    return samples
+
+
+def symbol_heat(cross_references, samples=None):
+    """Expected gain per symbol, from profile samples or from the cref fan-in without a profile"""
+    if not samples:
+        return dict((symbol, len(files) - 1) for symbol, files in cross_references.items() if files)
+
+    references_by_file = {}
+    for symbol, files in cross_references.items():
+        for referencing_file in files[1:]:
+            references_by_file.setdefault(referencing_file, []).append(symbol)
+
+    heat = dict(samples)
+    for symbol, count in samples.items():
+        files = cross_references.get(symbol)
+        if not files:
+            continue
+        callees = references_by_file.get(files[0], [])
+        for callee in callees:
+            heat[callee] = heat.get(callee, 0) + CALLEE_SHARE * count / len(callees)
+    return heat
+
+
+def rate_candidates(sections, heat):
+    return [Candidate(section, source, size, names, max(heat.get(name, 0) for name in names))
+            for section, source, size, names in sections]
+
+
+def pack(candidates, budget):
+    """Greedy 0/1 knapsack by heat per byte, falls back to the single hottest section when that is better"""
+    candidates = [c for c in candidates if c.heat > 0 and c.size <= budget]
+    candidates.sort(key=lambda c: c.heat / c.size, reverse=True)
+    chosen = []
+    used = 0
+    for candidate in candidates:
+        if used + candidate.size <= budget:
+            chosen.append(candidate)
+            used += candidate.size
+    if candidates:
+        hottest = max(candidates, key=lambda c: c.heat)
+        if hottest.heat > sum(c.heat for c in chosen):
+            return [hottest]
+    return chosen
+
+
+def pack_cold(candidates, budget, profiled):
+    """Largest cold sections first, code is only considered cold when a profile says so"""
+    if profiled:
+        cold = [c for c in candidates if c.heat == 0]
+    else:
+        cold = [c for c in candidates if c.section.startswith('.rodata.') and c.heat <= COLD_FAN_IN]
+    cold = [c for c in cold if split_source(c.source)[1] not in INTERNAL_OBJECTS]
+    cold.sort(key=lambda c: c.size, reverse=True)
+    chosen = []
+    used = 0
+    for candidate in cold:
+        if used + candidate.size <= budget:
+            chosen.append(candidate)
+            used += candidate.size
+    return chosen
+
+
+def anchored_name(path):
+    """ld file pattern matching the file name exactly, a bare `*main.o` also matches screen_main.o"""
+    if os.path.dirname(path):
+        return "*/" + os.path.basename(path)
+    return path
+
+
+def input_section_pattern(candidate):
+    archive, obj = split_source(candidate.source)
+    if archive.endswith('.a'):
+        return "%s:%s(%s)" % (anchored_name(archive), obj, candidate.section)
+    return "%s(%s)" % (anchored_name(candidate.source), candidate.section)
+
+
+def round_up_kb(size):
+    return (size + 1023) // 1024
+
+
+def linker_snippet(itcm, dtcm, quadspi, dtcm_budget):
+    lines = []
+    lines.append("/* MEMORY: add the TCM regions, RAM has to start after DTCMRAM */")
+    lines.append("ITCMRAM (xrw)  : ORIGIN = 0x%08X, LENGTH = %dK" % (ITCM_ORIGIN, round_up_kb(ITCM_SIZE)))
+    if dtcm:
+        dtcm_kb = round_up_kb(dtcm_budget)
+        lines.append("DTCMRAM (xrw)  : ORIGIN = 0x%08X, LENGTH = %dK" % (DTCM_ORIGIN, dtcm_kb))
+        lines.append("RAM (xrw)      : ORIGIN = 0x%08X, LENGTH = 320K - %dK" % (DTCM_ORIGIN + dtcm_kb * 1024, dtcm_kb))
+    lines.append("")
+    lines.append("/* SECTIONS: place before .text and .rodata so the wildcards there do not claim them */")
+    if itcm:
+        lines.append("  /* Copied from FLASH by the startup code, like .data */")
+        lines.append("  _siitcm = LOADADDR(.itcm_text);")
+        lines.append("  .itcm_text :")
+        lines.append("  {")
+        lines.append("    . = ALIGN(4);")
+        lines.append("    _sitcm = .;")
+        lines += ["    %s" % input_section_pattern(c) for c in itcm]
+        lines.append("    . = ALIGN(4);")
+        lines.append("    _eitcm = .;")
+        lines.append("  } >ITCMRAM AT> FLASH")
+        lines.append("")
+    if dtcm:
+        lines.append("  /* Copied from FLASH by the startup code, like .data */")
+        lines.append("  _sidtcm = LOADADDR(.dtcm_rodata);")
+        lines.append("  .dtcm_rodata :")
+        lines.append("  {")
+        lines.append("    . = ALIGN(4);")
+        lines.append("    _sdtcm = .;")
+        lines += ["    %s" % input_section_pattern(c) for c in dtcm]
+        lines.append("    . = ALIGN(4);")
+        lines.append("    _edtcm = .;")
+        lines.append("  } >DTCMRAM AT> FLASH")
+        lines.append("")
+    if quadspi:
+        lines.append("  .qspi_moved :")
+        lines.append("  {")
+        lines += ["    %s" % input_section_pattern(c) for c in quadspi]
+        lines.append("    . = ALIGN(0x4);")
+        lines.append("  } >QUADSPI")
+    return "\n".join(lines) + "\n"
+
+
+def print_placement(title, chosen, budget):
+    print("\n%s" % title)
+    for candidate in chosen:
+        print("%-40s \t%7s  (heat: %g %s)" % (candidate.section, candidate.size, candidate.heat,
+                                             os.path.normpath(candidate.source)))
+    used = sum(c.size for c in chosen)
+    print("TOTAL %s %d of %d  (heat: %g)" % (title, used, budget, sum(c.heat for c in chosen)))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Suggests input sections to move into ITCM, DTCM or QUADSPI.')
+    parser.add_argument('map_file', help="A map file generated by passing -Map and --cref to ld during linking.")
+    parser.add_argument('--itcm', type=int, default=ITCM_SIZE, help="ITCM budget in bytes for hot code")
+    parser.add_argument('--dtcm', type=int, default=0, help="DTCM budget in bytes for hot constant data")
+    parser.add_argument('--quadspi', type=int, default=None,
+                        help="QUADSPI budget in bytes for cold sections (default: free space in the map)")
+    parser.add_argument('--hot', help="Hot function list, `function [samples]` per line (e.g. from a profiler)")
+    parser.add_argument('--output', help="File to write the linker script snippets to (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    map_file, sections = collect_candidates(args.map_file)
+    samples = read_profile(args.hot) if args.hot else None
+    candidates = rate_candidates(sections, symbol_heat(map_file.cross_references, samples))
+
+    # The startup code fills the TCMs, what it runs or reads before that has to stay in FLASH
+    movable = [c for c in candidates if split_source(c.source)[1] not in INTERNAL_OBJECTS]
+    itcm = pack([c for c in movable if c.section.startswith('.text.')], args.itcm)
+    dtcm = pack([c for c in movable if c.section.startswith('.rodata.')], args.dtcm) if args.dtcm else []
+    quadspi_budget = args.quadspi
+    if quadspi_budget is None:
+        quadspi_budget = 0
+        if 'QUADSPI' in map_file.regions:
+            quadspi_budget = map_file.regions['QUADSPI'][1] - map_file.region_usage()['QUADSPI']
+    placed = set(c.section for c in itcm + dtcm)
+    quadspi = pack_cold([c for c in candidates if c.section not in placed], quadspi_budget, bool(samples))
+
+    if not map_file.cross_references and not samples:
+        print("Warning: no cross reference table in the map file (link with --cref) and no hot list")
+    print_placement("ITCM", itcm, args.itcm)
+    if args.dtcm:
+        print_placement("DTCM", dtcm, args.dtcm)
+    print_placement("QUADSPI", quadspi, quadspi_budget)
+    print("Internal FLASH freed: %d" % sum(c.size for c in quadspi))  # TCM code still loads from FLASH
+
+    snippet = linker_snippet(itcm, dtcm, quadspi, args.dtcm)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(snippet)
+    else:
+        print("")
+        print(snippet)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+"""Finds duplicated LVGL assets and constant data in one or more firmware images
+
+Every `.rodata*` input section and everything placed in QUADSPI is cut at
+the symbol boundaries of the map file and read from the ELF file next to it.
+The blobs are hashed to find exact duplicates across objects and projects,
+and near duplicates from the hashes of fixed size chunks. For every LVGL
+image descriptor the size of a palette, RLE or zlib encoding of its pixels
+is estimated.
+"""
+
+from __future__ import print_function
+
+import os
+import argparse
+import bisect
+import hashlib
+import struct
+import zlib
+from collections import namedtuple
+from itertools import groupby
+
+from analyze_map import MapFile, iter_symbols, split_source
+
+
+SHT_NOBITS = 8
+SHF_ALLOC = 0x2
+
+CHUNK_SIZE = 256
+MIN_SIZE = 64
+SIMILARITY = 0.5
+# Chunks found in more blobs than this are padding or tables every font has, they link nothing
+MAX_CHUNK_BLOBS = 32
+
+# lv_img_cf_t of LVGL v8
+LV_IMG_CF_TRUE_COLOR = 4
+LV_IMG_CF_TRUE_COLOR_ALPHA = 5
+LV_IMG_CF_TRUE_COLOR_CHROMA_KEYED = 6
+LV_IMG_CF_NAMES = {
+    1: "RAW", 2: "RAW_ALPHA", 3: "RAW_CHROMA_KEYED", 4: "TRUE_COLOR", 5: "TRUE_COLOR_ALPHA",
+    6: "TRUE_COLOR_CHROMA_KEYED", 7: "INDEXED_1BIT", 8: "INDEXED_2BIT", 9: "INDEXED_4BIT", 10: "INDEXED_8BIT",
+    11: "ALPHA_1BIT", 12: "ALPHA_2BIT", 13: "ALPHA_4BIT", 14: "ALPHA_8BIT",
+}
+LV_IMG_DSC_SIZE = 12  # lv_img_header_t, data_size, data pointer
+
+Blob = namedtuple('Blob', 'project region section symbol source address data')
+Image = namedtuple('Image', 'descriptor pixels cf width height pixel_size')
+
+
+class ElfImage():
+    """The allocated sections of an ELF file, read by address"""
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.data = f.read()
+        if self.data[:4] != b'\x7fELF':
+            raise ValueError("Not an ELF file: %s" % path)
+        endian = '<' if self.data[5] == 1 else '>'
+        if self.data[4] == 2:
+            shoff, = struct.unpack_from(endian + 'Q', self.data, 0x28)
+            shentsize, shnum = struct.unpack_from(endian + 'HH', self.data, 0x3A)
+            header = endian + 'IIQQQQ'
+        else:
+            shoff, = struct.unpack_from(endian + 'I', self.data, 0x20)
+            shentsize, shnum = struct.unpack_from(endian + 'HH', self.data, 0x2E)
+            header = endian + 'IIIIII'
+        sections = []
+        for index in range(shnum):
+            name, kind, flags, address, offset, size = struct.unpack_from(header, self.data, shoff + index * shentsize)
+            if kind != SHT_NOBITS and flags & SHF_ALLOC and size:
+                sections.append((address, size, offset))
+        sections.sort()
+        self.sections = sections
+        self.addresses = [section[0] for section in sections]
+        self.view = memoryview(self.data)
+
+    def read(self, address, size):
+        """The bytes at a run time address, None when no section holds all of them"""
+        index = bisect.bisect_right(self.addresses, address) - 1
+        if index < 0:
+            return None
+        start, section_size, offset = self.sections[index]
+        if address + size > start + section_size:
+            return None
+        return self.view[offset + address - start:offset + address - start + size]
+
+
+def is_asset_section(input_section):
+    return input_section.output_section.startswith('.rodata') or 'QUADSPI' in (input_section.region,
+                                                                               input_section.load_region)
+
+
+def collect_blobs(project, elf_file, map_file):
+    """One Blob per symbol of the constant data, symbol-less sections are named after the input section"""
+    elf = ElfImage(elf_file)
+    blobs = []
+    def listener(input_section):
+        if not is_asset_section(input_section):
+            return
+        for symbol, address, size in iter_symbols(input_section):
+            data = elf.read(address, size)
+            if data is None:
+                continue
+            blobs.append(Blob(project, input_section.region, input_section.section,
+                              symbol or input_section.section, input_section.source, address, data))
+    MapFile(map_file, listener=listener)
+    return blobs
+
+
+def blob_name(blob):
+    return "%s:%s(%s)" % (blob.project, blob.symbol, split_source(blob.source)[1])
+
+
+def exact_duplicates(blobs):
+    """Groups of blobs with the same content, the largest waste first"""
+    groups = {}
+    for blob in blobs:
+        groups.setdefault(hashlib.blake2b(blob.data, digest_size=16).digest(), []).append(blob)
+    duplicates = [group for group in groups.values() if len(group) > 1]
+    duplicates.sort(key=lambda group: duplicate_saving(group), reverse=True)
+    return groups, duplicates
+
+
+def duplicate_saving(group):
+    """Bytes saved by keeping one copy per project, copies in other projects are not counted"""
+    projects = set(blob.project for blob in group)
+    return (len(group) - len(projects)) * len(group[0].data)
+
+
+def chunk_hashes(data, chunk_size):
+    """Hashes of the chunks of a blob, chunks of a single repeated byte are left out"""
+    hashes = set()
+    for offset in range(0, len(data) - chunk_size + 1, chunk_size):
+        chunk = data[offset:offset + chunk_size]
+        if chunk.tobytes().count(chunk[0]) == chunk_size:
+            continue
+        hashes.add(hashlib.blake2b(chunk, digest_size=8).digest())
+    return hashes
+
+
+def near_duplicates(blobs, chunk_size=CHUNK_SIZE, similarity=SIMILARITY):
+    """(similarity, shared bytes, blob, blob) of distinct blobs sharing enough chunks"""
+    chunks = [chunk_hashes(blob.data, chunk_size) for blob in blobs]
+    blobs_by_chunk = {}
+    for index, hashes in enumerate(chunks):
+        for digest in hashes:
+            blobs_by_chunk.setdefault(digest, []).append(index)
+    shared = {}
+    for indexes in blobs_by_chunk.values():
+        if len(indexes) < 2 or len(indexes) > MAX_CHUNK_BLOBS:
+            continue
+        for position, first in enumerate(indexes):
+            for second in indexes[position + 1:]:
+                shared[(first, second)] = shared.get((first, second), 0) + 1
+    pairs = []
+    for (first, second), count in shared.items():
+        ratio = count / max(len(chunks[first]), len(chunks[second]))
+        if ratio >= similarity:
+            pairs.append((ratio, count * chunk_size, blobs[first], blobs[second]))
+    pairs.sort(key=lambda pair: pair[1], reverse=True)
+    return pairs
+
+
+def pixel_sizes(cf, width, height, data_size):
+    """Bytes per pixel a true color descriptor can have with the given data size"""
+    sizes = (1, 2, 4) if cf != LV_IMG_CF_TRUE_COLOR_ALPHA else (2, 3, 4)  # LV_COLOR_DEPTH 8, 16, 32
+    return [size for size in sizes if width * height * size == data_size]
+
+
+def find_images(blobs):
+    """LVGL v8 lv_img_dsc_t blobs with true color pixels, paired with the blob of their pixels"""
+    by_address = dict(((blob.project, blob.address), blob) for blob in blobs)
+    images = []
+    for blob in blobs:
+        if len(blob.data) != LV_IMG_DSC_SIZE:
+            continue
+        header, data_size, pointer = struct.unpack('<III', blob.data)
+        cf, always_zero = header & 0x1F, (header >> 5) & 0x7
+        width, height = (header >> 10) & 0x7FF, (header >> 21) & 0x7FF
+        if always_zero or cf not in LV_IMG_CF_NAMES or not width or not height:
+            continue
+        pixels = by_address.get((blob.project, pointer))
+        if pixels is None or len(pixels.data) < data_size:
+            continue
+        if cf not in (LV_IMG_CF_TRUE_COLOR, LV_IMG_CF_TRUE_COLOR_ALPHA, LV_IMG_CF_TRUE_COLOR_CHROMA_KEYED):
+            images.append(Image(blob, pixels, cf, width, height, None))  # Already encoded
+            continue
+        sizes = pixel_sizes(cf, width, height, data_size)
+        if sizes:
+            images.append(Image(blob, pixels, cf, width, height, sizes[0]))
+    return images
+
+
+def iter_pixels(data, pixel_size):
+    if pixel_size in (1, 2, 4):
+        return iter(data.cast({1: 'B', 2: 'H', 4: 'I'}[pixel_size]))
+    return zip(*(data[index::pixel_size].tobytes() for index in range(pixel_size)))
+
+
+def encoding_sizes(image):
+    """Estimated size of the pixels as LVGL indexed image, RLE runs and zlib stream"""
+    data = image.pixels.data[:image.width * image.height * image.pixel_size]
+    sizes = {}
+    colors = len(set(iter_pixels(data, image.pixel_size)))
+    if colors <= 256:
+        bits = next(bits for bits in (1, 2, 4, 8) if colors <= 1 << bits)
+        sizes['palette'] = 4 * (1 << bits) + (image.width * bits + 7) // 8 * image.height
+    runs = sum(1 for _ in groupby(iter_pixels(data, image.pixel_size)))
+    sizes['rle'] = runs * (1 + image.pixel_size)  # A count byte in front of every run
+    sizes['zlib'] = len(zlib.compress(data.tobytes(), 6))
+    return sizes
+
+
+def print_duplicates(duplicates, top):
+    print("\nEXACT DUPLICATES")
+    for group in duplicates[:top]:
+        print("%7s x%-3d saving %7d  %s" % (len(group[0].data), len(group), duplicate_saving(group),
+                                          "  ".join(blob_name(blob) for blob in group)))
+    print("TOTAL saving %d in %d groups" % (sum(duplicate_saving(group) for group in duplicates), len(duplicates)))
+
+
+def print_near_duplicates(pairs, top):
+    print("\nNEAR DUPLICATES")
+    for ratio, shared, first, second in pairs[:top]:
+        print("%3d%% shared %7d  %s (%d)  %s (%d)" % (ratio * 100, shared, blob_name(first), len(first.data),
+                                                    blob_name(second), len(second.data)))
+    print("TOTAL shared %d in %d pairs" % (sum(pair[1] for pair in pairs), len(pairs)))
+
+
+def print_images(images, top):
+    print("\nIMAGES")
+    rows = []
+    for image in images:
+        size = len(image.pixels.data)
+        if image.pixel_size is None:
+            rows.append((0, "%-40s %4dx%-4d %-24s %7d  encoded" % (
+                blob_name(image.descriptor), image.width, image.height, LV_IMG_CF_NAMES[image.cf], size)))
+            continue
+        sizes = encoding_sizes(image)
+        best = min(sizes, key=sizes.get)
+        saving = max(size - sizes[best], 0)
+        rows.append((saving, "%-40s %4dx%-4d %-24s %7d  %s %d, saving %d" % (
+            blob_name(image.descriptor), image.width, image.height, LV_IMG_CF_NAMES[image.cf], size,
+            best, sizes[best], saving)))
+    rows.sort(key=lambda row: row[0], reverse=True)
+    for saving, line in rows[:top]:
+        print(line)
+    print("TOTAL re-encoding saving %d in %d images" % (sum(row[0] for row in rows), len(rows)))
+
+
+def print_totals(blobs):
+    print("\nCONSTANT DATA")
+    totals = {}
+    for blob in blobs:
+        key = (blob.project, blob.region)
+        totals[key] = totals.get(key, 0) + len(blob.data)
+    for (project, region), size in sorted(totals.items()):
+        print("%-20s %-10s %9d" % (project, region, size))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Finds duplicated LVGL assets and constant data.')
+    parser.add_argument('elf_file', nargs='+', help="ELF files, each with its map file next to it (name.map)")
+    parser.add_argument('--min-size', type=int, default=MIN_SIZE, help="Ignore blobs smaller than this")
+    parser.add_argument('--chunk', type=int, default=CHUNK_SIZE, help="Chunk size for near duplicate detection")
+    parser.add_argument('--similarity', type=float, default=SIMILARITY,
+                        help="Share of chunks two blobs need in common to be near duplicates")
+    parser.add_argument('--top', type=int, default=20, help="Number of rows to print per table")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    blobs = []
+    for elf_file in args.elf_file:
+        project = os.path.splitext(os.path.basename(elf_file))[0]
+        blobs += collect_blobs(project, elf_file, os.path.splitext(elf_file)[0] + '.map')
+
+    print_totals(blobs)
+    images = find_images(blobs)
+    blobs = [blob for blob in blobs if len(blob.data) >= args.min_size]
+    groups, duplicates = exact_duplicates(blobs)
+    print_duplicates(duplicates, args.top)
+    # One blob per content, exact copies are already reported
+    print_near_duplicates(near_duplicates([group[0] for group in groups.values()], args.chunk, args.similarity),
+                          args.top)
+    print_images(images, args.top)
+
+
+if __name__ == '__main__':
+    main()
@@ -27,12 +27,10 @@ from __future__ import print_function
 import sys
 import os
 import argparse
+import csv
+import json
+from collections import namedtuple
 
-parser = argparse.ArgumentParser(description='Summarises the size of each object file in an ld linker map.')
-parser.add_argument('map_file', help="A map file generated by passing -M/--print-map to ld during linking.")
-parser.add_argument('--combine', action='store_true',
-                    help="All object files in an .a archive or in a directory are combined")
-args = parser.parse_args()
 
 class SectionSize():
     code = 0
@@ -51,64 +49,467 @@ class SectionSize():
         elif section != '.bss':
             self.data += size
 
-size_by_source = {}
-with open(args.map_file) as f:
-    lines = iter(f)
-    for line in lines:
-        if line.strip() == "Linker script and memory map":
-            break
-
-    current_section = None
-    split_line = None
-    for line in lines:
-        line = line.strip('\n')
-        if split_line:
-            # Glue a line that was split in two back together
-            if line.startswith(' ' * 16):
-                line = split_line + line
-            else:  # Shouldn't happen
-                print("Warning: discarding line ", split_line)
-            split_line = None
-
-        if line.startswith((".", " .", " *fill*")):
-            pieces = line.split(None, 3)  # Don't split paths containing spaces
-
-            if line.startswith("."):
-                # Note: this line might be wrapped, with the size of the section
-                # on the next line, but we ignore the size anyway and will ignore that line
-                current_section = pieces[0]
-            elif len(pieces) == 1 and len(line) > 14:
-                # ld splits the rest of this line onto the next if the section name is too long
-                split_line = line
-            elif len(pieces) >= 3 and "=" not in pieces and "before" not in pieces:
-                if pieces[0] == "*fill*":
-                    source = pieces[0]
-                    size = int(pieces[-1], 16)
-                else:
-                    source = pieces[-1]
-                    size = int(pieces[-2], 16)
-
-                if args.combine:
-                    if '.a(' in source:
-                        # path/to/archive.a(object.o)
-                        source = source[:source.index('.a(') + 2]
-                    elif source.endswith('.o'):
-                        where = max(source.rfind('\\'), source.rfind('/'))
-                        if where:
-                            source = source[:where + 1] + '*.o'
-
-                if source not in size_by_source:
-                    size_by_source[source] = SectionSize()
-                size_by_source[source].add_section(current_section, size)
-
-# Print out summary
-sources = list(size_by_source.keys())
-sources.sort(key = lambda x: size_by_source[x].total())
-sumtotal = sumcode = sumdata = 0
-for source in sources:
-    size = size_by_source[source]
-    sumcode += size.code
-    sumdata += size.data
-    sumtotal += size.total()
-    print("%-40s \t%7s  (code: %d data: %d)" % (os.path.normpath(source), size.total(), size.code, size.data))
-print("TOTAL %d  (code: %d data: %d)" % (sumtotal, sumcode, sumdata))
+
+# Output sections that only reserve space, they have no load image even when ld prints a load address
+NOLOAD_SECTIONS = ('.bss', '.noinit', '._user_heap_stack')
+
+
+# An input section as it is streamed to a listener, symbols are (address, name) in map order
+# load_offset moves a run address to its load address (LMA - VMA) when the section is copied at startup
+InputSection = namedtuple('InputSection',
+                          'region load_region load_offset output_section section address size source symbols')
+
+
+def combine_source(source):
+    """Collapse an object file path onto its archive or directory"""
+    if '.a(' in source:
+        # path/to/archive.a(object.o)
+        source = source[:source.index('.a(') + 2]
+    elif source.endswith('.o'):
+        where = max(source.rfind('\\'), source.rfind('/'))
+        if where:
+            source = source[:where + 1] + '*.o'
+    return source
+
+
+def split_source(source):
+    """Split a source into (archive, object), objects outside an archive are grouped by directory"""
+    if '.a(' in source and source.endswith(')'):
+        where = source.index('.a(') + 2
+        return source[:where], source[where + 1:-1]
+    return os.path.dirname(source), os.path.basename(source)
+
+
+def iter_symbols(input_section):
+    """Yield (symbol, address, size) covering an input section, bytes before the first symbol have no name"""
+    end = input_section.address + input_section.size
+    symbols = sorted(symbol for symbol in input_section.symbols if input_section.address <= symbol[0] < end)
+    if not symbols or symbols[0][0] > input_section.address:
+        symbols.insert(0, (input_section.address, ""))
+    for index, (address, name) in enumerate(symbols):
+        next_address = symbols[index + 1][0] if index + 1 < len(symbols) else end
+        if next_address > address:
+            yield name, address, next_address - address
+
+
+class MapFile():
+    """The sizes parsed from one ld map file
+
+    The parsed state is kept in memory so that a long running caller
+    (`invoke watch`) can compare two builds without re-spawning this script.
+    A `listener` is called with every InputSection as soon as its symbols are
+    known, which lets the exporters stream a map without keeping it around.
+    """
+    def __init__(self, map_file, combine=False, listener=None):
+        self.map_file = map_file
+        self.combine = combine
+        self.listener = listener
+        self.input_section = None  # Waiting for its symbol lines before going to the listener
+        self.regions = {}  # name -> (origin, length), from "Memory Configuration"
+        self.output_sections = []  # (name, address, size, load address or None)
+        self.size_by_source = {}
+        self.size_by_region = {}  # region -> source -> output section -> size
+        self.load_region = None  # Region holding the load image of the current output section
+        self.load_offset = 0  # Load address minus run address of the current output section
+        self.cross_references = {}  # symbol -> [defining file, referencing files...], needs ld --cref
+        with open(map_file) as f:
+            self.parse(f)
+
+    def parse(self, f):
+        lines = iter(f)
+        for line in lines:
+            if line.strip() == "Memory Configuration":
+                self.parse_memory_configuration(lines)
+            if line.strip() == "Linker script and memory map":
+                break
+
+        current_section = None
+        pending_section = None
+        split_line = None
+        for line in lines:
+            line = line.strip('\n')
+            if line == "Cross Reference Table":
+                self.parse_cross_references(lines)
+                break
+            if pending_section:
+                # ld puts the address and size of a long output section name on the next line
+                if line.startswith(' ' * 16):
+                    self.add_output_section(pending_section + line)
+                pending_section = None
+                continue
+
+            if split_line:
+                # Glue a line that was split in two back together
+                if line.startswith(' ' * 16):
+                    line = split_line + line
+                else:  # Shouldn't happen
+                    print("Warning: discarding line ", split_line)
+                split_line = None
+
+            if line.startswith((".", " .", " *fill*", " COMMON")):
+                pieces = line.split(None, 3)  # Don't split paths containing spaces
+
+                if line.startswith("."):
+                    self.flush_input_section()
+                    current_section = pieces[0]
+                    self.load_region = None
+                    self.load_offset = 0
+                    if len(pieces) == 1:
+                        pending_section = line
+                    else:
+                        self.add_output_section(line)
+                elif len(pieces) == 1 and len(line) > 14:
+                    # ld splits the rest of this line onto the next if the section name is too long
+                    split_line = line
+                elif len(pieces) >= 3 and "=" not in pieces and "before" not in pieces:
+                    if pieces[0] == "*fill*":
+                        source = pieces[0]
+                        size = int(pieces[-1], 16)
+                    else:
+                        source = pieces[-1]
+                        size = int(pieces[-2], 16)
+
+                    self.flush_input_section()
+                    if self.listener is not None:
+                        self.input_section = InputSection(self.region_of(int(pieces[1], 16)), self.load_region,
+                                                          self.load_offset, current_section, pieces[0], int(pieces[1], 16), size,
+                                                          self.region_source(current_section, source), [])
+
+                    if self.combine:
+                        source = combine_source(source)
+
+                    if pieces[0] != "COMMON":  # Zero-initialised, the summary leaves it out like .bss
+                        if source not in self.size_by_source:
+                            self.size_by_source[source] = SectionSize()
+                        self.size_by_source[source].add_section(current_section, size)
+                    self.add_region_section(current_section, int(pieces[1], 16), size, source)
+            elif self.input_section is not None and line.startswith(' ' * 16):
+                pieces = line.split()
+                if len(pieces) == 2 and pieces[0].startswith("0x"):
+                    self.input_section.symbols.append((int(pieces[0], 16), pieces[1]))
+        self.flush_input_section()
+
+    def flush_input_section(self):
+        input_section = self.input_section
+        self.input_section = None
+        if input_section is not None and input_section.size and input_section.region is not None:
+            self.listener(input_section)
+
+    def region_source(self, section, source):
+        if source == "*fill*" and section.startswith(NOLOAD_SECTIONS):
+            # The heap and stack are reserved by moving the location counter
+            return section
+        return source
+
+    def parse_memory_configuration(self, lines):
+        for line in lines:
+            pieces = line.split()
+            if not pieces:
+                if self.regions:
+                    return
+                continue
+            if len(pieces) >= 3 and pieces[1].startswith("0x") and pieces[0] != "*default*":
+                self.regions[pieces[0]] = (int(pieces[1], 16), int(pieces[2], 16))
+
+    def parse_cross_references(self, lines):
+        symbol = None
+        for line in lines:
+            line = line.rstrip('\n')
+            if not line.strip() or line.startswith("Symbol "):
+                continue
+            if line[0] != ' ':
+                pieces = line.split(None, 1)
+                symbol = pieces[0]
+                self.cross_references[symbol] = pieces[1:]
+            elif symbol is not None:
+                self.cross_references[symbol].append(line.strip())
+
+    def add_output_section(self, line):
+        pieces = line.split()
+        if len(pieces) < 3 or not pieces[1].startswith("0x"):
+            return
+        load_address = None
+        if "load address" in line:
+            load_address = int(pieces[-1], 16)
+        self.output_sections.append((pieces[0], int(pieces[1], 16), int(pieces[2], 16), load_address))
+        if load_address is not None and not pieces[0].startswith(NOLOAD_SECTIONS):
+            load_region = self.region_of(load_address)
+            if load_region != self.region_of(int(pieces[1], 16)):
+                self.load_region = load_region
+                self.load_offset = load_address - int(pieces[1], 16)
+
+    def add_region_section(self, section, address, size, source):
+        """Attribute an input section to the region it runs from, and its load image to the region it is stored in"""
+        if size == 0:
+            return
+        region = self.region_of(address)
+        if region is None:
+            return  # Debug info and attributes do not occupy target memory
+        source = self.region_source(section, source)
+        regions = [region]
+        if self.load_region is not None:
+            regions.append(self.load_region + " (load)")
+        for region in regions:
+            by_source = self.size_by_region.setdefault(region, {})
+            by_section = by_source.setdefault(source, {})
+            by_section[section] = by_section.get(section, 0) + size
+
+    def region_of(self, address):
+        for region, (origin, length) in self.regions.items():
+            if origin <= address < origin + length:
+                return region
+        return None
+
+    def region_usage(self):
+        """Bytes used per memory region, the same figures as --print-memory-usage"""
+        usage = dict.fromkeys(self.regions, 0)
+        for name, address, size, load_address in self.output_sections:
+            region = self.region_of(address)
+            if region is not None:
+                usage[region] += size
+            if load_address is not None and not name.startswith(NOLOAD_SECTIONS):
+                load_region = self.region_of(load_address)
+                if load_region is not None and load_region != region:
+                    usage[load_region] += size
+        return usage
+
+
+EXPORT_FIELDS = ['project', 'region', 'archive', 'object', 'output_section', 'section', 'symbol', 'address', 'size']
+
+
+def iter_export_rows(project, input_section):
+    """Yield one EXPORT_FIELDS row per symbol, again at its load address for the load image of initialised data"""
+    archive, obj = split_source(input_section.source)
+    regions = [(input_section.region, 0)]
+    if input_section.load_region is not None:
+        regions.append((input_section.load_region + " (load)", input_section.load_offset))
+    for symbol, address, size in iter_symbols(input_section):
+        for region, offset in regions:
+            yield [project, region, archive, obj, input_section.output_section, input_section.section,
+                   symbol, address + offset, size]
+
+
+class JsonLinesWriter():
+    def __init__(self, f):
+        self.f = f
+    def write(self, row):
+        self.f.write(json.dumps(dict(zip(EXPORT_FIELDS, row))) + "\n")
+    def close(self):
+        pass
+
+
+class CsvWriter():
+    def __init__(self, f):
+        self.writer = csv.writer(f)
+        self.writer.writerow(EXPORT_FIELDS)
+    def write(self, row):
+        self.writer.writerow(row)
+    def close(self):
+        pass
+
+
+TREEMAP_HEADER = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Size treemap</title>
+<style>
+body { font: 12px sans-serif; margin: 8px; }
+#path span { cursor: pointer; color: #06c; }
+#map { position: relative; width: 100%; height: 90vh; }
+#map div { position: absolute; box-sizing: border-box; border: 1px solid #fff; overflow: hidden; cursor: pointer; }
+#map div div { border-color: rgba(255, 255, 255, 0.5); cursor: inherit; }
+</style></head>
+<body><div id="path"></div><div id="map"></div>
+<script>
+var S = [], root = {name: "all", size: 0, children: {}};
+function s(x) { S.push(x); }
+function r() {
+  var node = root, size = arguments[arguments.length - 1];
+  root.size += size;
+  for (var i = 0; i < arguments.length - 1; i++) {
+    var name = S[arguments[i]], child = node.children[name];
+    if (!child) child = node.children[name] = {name: name, size: 0, children: {}, parent: node};
+    child.size += size;
+    node = child;
+  }
+}
+"""
+
+TREEMAP_FOOTER = """
+function sorted(node) {
+  var list = [];
+  for (var name in node.children) if (node.children[name].size > 0) list.push(node.children[name]);
+  return list.sort(function (a, b) { return b.size - a.size; });
+}
+function worst(areas, side) {
+  var sum = 0, max = 0, min = Infinity;
+  areas.forEach(function (a) { sum += a; max = Math.max(max, a); min = Math.min(min, a); });
+  return Math.max(side * side * max / (sum * sum), sum * sum / (side * side * min));
+}
+function squarify(nodes, x, y, w, h) {
+  var total = 0, rects = [], i = 0;
+  nodes.forEach(function (n) { total += n.size; });
+  var areas = nodes.map(function (n) { return n.size * w * h / total; });
+  while (i < nodes.length) {
+    var side = Math.min(w, h), row = [areas[i]], j = i + 1;
+    while (j < nodes.length && worst(row.concat([areas[j]]), side) <= worst(row, side)) row.push(areas[j++]);
+    var thick = row.reduce(function (a, b) { return a + b; }, 0) / side, offset = 0;
+    row.forEach(function (area, k) {
+      var length = area / thick;
+      if (w >= h) rects.push([nodes[i + k], x, y + offset, thick, length]);
+      else rects.push([nodes[i + k], x + offset, y, length, thick]);
+      offset += length;
+    });
+    if (w >= h) { x += thick; w -= thick; } else { y += thick; h -= thick; }
+    i = j;
+  }
+  return rects;
+}
+function box(parent, rect, color) {
+  var div = document.createElement("div");
+  div.style.left = rect[1] + "px"; div.style.top = rect[2] + "px";
+  div.style.width = rect[3] + "px"; div.style.height = rect[4] + "px";
+  div.style.background = color;
+  div.title = (rect[0].name || "(unnamed)") + "\\n" + rect[0].size + " bytes";
+  parent.appendChild(div);
+  return div;
+}
+function render(node) {
+  var map = document.getElementById("map"), path = document.getElementById("path");
+  map.innerHTML = ""; path.innerHTML = "";
+  for (var n = node; n; n = n.parent) {
+    var span = document.createElement("span");
+    span.textContent = (n.name || "(unnamed)") + " (" + n.size + ")";
+    span.onclick = (function (target) { return function () { render(target); }; })(n);
+    path.insertBefore(document.createTextNode(n === node ? "" : " / "), path.firstChild);
+    path.insertBefore(span, path.firstChild);
+  }
+  squarify(sorted(node), 0, 0, map.clientWidth, map.clientHeight).forEach(function (rect, index) {
+    var hue = (index * 47) % 360, div = box(map, rect, "hsl(" + hue + ",55%,55%)");
+    div.onclick = function () { if (sorted(rect[0]).length) render(rect[0]); };
+    if (rect[3] > 40 && rect[4] > 40) {
+      squarify(sorted(rect[0]), 0, 14, rect[3] - 2, rect[4] - 16).forEach(function (inner) {
+        box(div, inner, "hsl(" + hue + ",55%,70%)");
+      });
+    }
+    div.appendChild(document.createTextNode(rect[0].name || "(unnamed)"));
+  });
+}
+render(root);
+window.onresize = function () { render(root); };
+</script></body></html>
+"""
+
+
+class TreemapWriter():
+    """Self-contained HTML treemap, project -> region -> archive -> object -> section -> symbol
+
+    Rows are written as script calls while the maps are parsed, the page
+    builds the hierarchy once when it loads. Names are written once and
+    referred to by index afterwards.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.strings = {}
+        self.f.write(TREEMAP_HEADER)
+    def string(self, value):
+        if value not in self.strings:
+            self.strings[value] = len(self.strings)
+            self.f.write("s(%s);\n" % json.dumps(value).replace("</", "<\\/"))
+        return self.strings[value]
+    def write(self, row):
+        project, region, archive, obj, output_section, section, symbol, address, size = row
+        path = [self.string(value) for value in (project, region, archive, obj, section, symbol)]
+        self.f.write("r(%s,%d);\n" % (",".join(str(index) for index in path), size))
+    def close(self):
+        self.f.write(TREEMAP_FOOTER)
+
+
+EXPORT_WRITERS = {
+    'jsonl': JsonLinesWriter,
+    'csv': CsvWriter,
+    'html': TreemapWriter,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Summarises the size of each object file in an ld linker map.')
+    parser.add_argument('map_file', nargs='+',
+                        help="A map file generated by passing -M/--print-map to ld during linking.")
+    parser.add_argument('--combine', action='store_true',
+                        help="All object files in an .a archive or in a directory are combined")
+    parser.add_argument('--regions', action='store_true',
+                        help="Break the sizes down per memory region (RAM, FLASH, QUADSPI, SDRAM), "
+                             "including .bss, .noinit, heap/stack and the FLASH load image of .data")
+    parser.add_argument('--format', choices=['text'] + sorted(EXPORT_WRITERS), default='text',
+                        help="Export symbol level sizes of every map file as JSON lines, CSV or an HTML treemap")
+    parser.add_argument('--output', help="File to write the export to (default: stdout)")
+    return parser.parse_args(argv)
+
+
+def export(map_files, output_format, output=None):
+    f = open(output, 'w', newline='') if output else sys.stdout
+    try:
+        writer = EXPORT_WRITERS[output_format](f)
+        for map_file in map_files:
+            project = os.path.splitext(os.path.basename(map_file))[0]
+            def listener(input_section):
+                for row in iter_export_rows(project, input_section):
+                    writer.write(row)
+            MapFile(map_file, listener=listener)
+        writer.close()
+    finally:
+        if output:
+            f.close()
+
+
+def print_regions(map_file):
+    for region in sorted(map_file.size_by_region):
+        by_source = map_file.size_by_region[region]
+        print("\n%s" % region)
+        sources = sorted(by_source, key=lambda x: sum(by_source[x].values()))
+        sumtotal = 0
+        for source in sources:
+            by_section = by_source[source]
+            total = sum(by_section.values())
+            sumtotal += total
+            detail = " ".join("%s: %d" % (section, by_section[section]) for section in sorted(by_section))
+            print("%-40s \t%7s  (%s)" % (os.path.normpath(source), total, detail))
+        if region in map_file.regions:
+            length = map_file.regions[region][1]
+            used = map_file.region_usage()[region]
+            print("TOTAL %s %d  (free: %d of %d)" % (region, sumtotal, length - used, length))
+        else:
+            print("TOTAL %s %d" % (region, sumtotal))
+
+
+def print_summary(map_file, regions=False):
+    if regions:
+        print_regions(map_file)
+        return
+    size_by_source = map_file.size_by_source
+
+    # Print out summary
+    sources = list(size_by_source.keys())
+    sources.sort(key = lambda x: size_by_source[x].total())
+    sumtotal = sumcode = sumdata = 0
+    for source in sources:
+        size = size_by_source[source]
+        sumcode += size.code
+        sumdata += size.data
+        sumtotal += size.total()
+        print("%-40s \t%7s  (code: %d data: %d)" % (os.path.normpath(source), size.total(), size.code, size.data))
+    print("TOTAL %d  (code: %d data: %d)" % (sumtotal, sumcode, sumdata))
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.format != 'text':
+        export(args.map_file, args.format, args.output)
+        return
+    for path in args.map_file:
+        if len(args.map_file) > 1:
+            print("\n%s" % path)
+        print_summary(MapFile(path, combine=args.combine), regions=args.regions)
+
+
+if __name__ == '__main__':
+    main()
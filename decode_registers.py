@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""Decodes raw STM32F746 register values into named fields using the SVD file
+
+The SVD is parsed once with a streaming XML parser into an index
+(build/svd_index.pickle) that is rebuilt only when the SVD changes. The dump
+to decode is read from a file, from a GDB session or from OpenOCD. The
+accepted lines are:
+
+    GPIOA.MODER 0xA8000000              register name and value
+    0x40020000 0xA8000000               address and value
+    0x40020000: a8000000 00000000 ...   consecutive words (OpenOCD mdw, GDB x/wx)
+"""
+
+from __future__ import print_function
+
+import sys
+import os
+import re
+import argparse
+import pickle
+import socket
+import subprocess
+import xml.etree.ElementTree as ET
+
+
+SVD_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "STM32F746.svd")
+INDEX_FILE = os.path.join("build", "svd_index.pickle")
+INDEX_VERSION = 1
+
+WORDS_LINE = re.compile(r'^\s*(0x[0-9a-fA-F]+)\s*(?:<[^>]*>)?\s*:\s*(.*)$')
+
+
+def svd_int(text):
+    text = text.strip().lower()
+    if text.startswith('#'):
+        return int(text[1:].replace('x', '0'), 2)  # Binary with don't care bits
+    if text.startswith('0x'):
+        return int(text, 16)
+    return int(text, 10)  # Some values come with leading zeros
+
+
+def field_bits(field):
+    """(lsb, width) of an SVD field, from bitOffset/bitWidth, lsb/msb or bitRange"""
+    if field.find('bitOffset') is not None:
+        width = field.find('bitWidth')
+        return svd_int(field.find('bitOffset').text), svd_int(width.text) if width is not None else 1
+    if field.find('lsb') is not None:
+        lsb = svd_int(field.find('lsb').text)
+        return lsb, svd_int(field.find('msb').text) - lsb + 1
+    msb, lsb = field.find('bitRange').text.strip('[]').split(':')
+    return int(lsb), int(msb) - int(lsb) + 1
+
+
+def parse_registers(peripheral, default_size, default_reset):
+    """{register: (offset, size, reset, [(field, lsb, width)])} of one peripheral element"""
+    registers = {}
+    for register in peripheral.iter('register'):
+        size = register.find('size')
+        reset = register.find('resetValue')
+        fields = []
+        for field in register.iter('field'):
+            lsb, width = field_bits(field)
+            fields.append((field.find('name').text, lsb, width))
+        fields.sort(key=lambda field: field[1], reverse=True)
+        registers[register.find('name').text] = (
+            svd_int(register.find('addressOffset').text),
+            svd_int(size.text) if size is not None else default_size,
+            svd_int(reset.text) if reset is not None else default_reset,
+            fields,
+        )
+    return registers
+
+
+def build_index(svd_file):
+    """Stream the SVD one peripheral at a time, the element tree is cleared as it goes"""
+    default_size = 32
+    default_reset = 0
+    peripherals = {}  # name -> (base address, {register: (offset, size, reset, fields)})
+    derived = []
+    depth = 0
+    for event, element in ET.iterparse(svd_file, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1 and element.tag == 'size':
+            default_size = svd_int(element.text)
+        elif depth == 1 and element.tag == 'resetValue':
+            default_reset = svd_int(element.text)
+        elif element.tag == 'peripheral':
+            name = element.find('name').text
+            base = svd_int(element.find('baseAddress').text)
+            if element.get('derivedFrom'):
+                derived.append((name, base, element.get('derivedFrom')))
+            else:
+                peripherals[name] = (base, parse_registers(element, default_size, default_reset))
+            element.clear()
+    for name, base, parent in derived:
+        # Derived peripherals share the register layout, pickle stores it once
+        peripherals[name] = (base, peripherals[parent][1])
+
+    registers = {}
+    addresses = {}
+    for peripheral, (base, layout) in peripherals.items():
+        for register, (offset, size, reset, fields) in layout.items():
+            name = peripheral + "." + register
+            registers[name] = (base + offset, size, reset, fields)
+            addresses.setdefault(base + offset, []).append(name)
+    return {
+        'peripherals': dict((name, (base, sorted(layout, key=lambda register: layout[register][0])))
+                            for name, (base, layout) in peripherals.items()),
+        'registers': registers,
+        'addresses': addresses,
+    }
+
+
+def load_index(svd_file=SVD_FILE, index_file=INDEX_FILE):
+    stat = os.stat(svd_file)
+    key = (INDEX_VERSION, os.path.abspath(svd_file), stat.st_size, stat.st_mtime_ns)
+    if os.path.isfile(index_file):
+        with open(index_file, 'rb') as f:
+            try:
+                index = pickle.load(f)
+                if index.get('key') == key:
+                    return index
+            except (pickle.UnpicklingError, EOFError, AttributeError):
+                pass
+    index = build_index(svd_file)
+    index['key'] = key
+    os.makedirs(os.path.dirname(index_file) or '.', exist_ok=True)
+    with open(index_file, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return index
+
+
+def lookup(index, name, peripheral=None):
+    """Register names for `PERIPH.REG`, `REG` within `peripheral` or an address"""
+    if re.match(r'^(0x[0-9a-fA-F]+|\d+)$', name):
+        return index['addresses'].get(int(name, 0), [])
+    if '.' not in name and peripheral is not None:
+        name = peripheral + "." + name
+    name = name.upper()
+    return [name] if name in index['registers'] else []
+
+
+def parse_hex(text):
+    try:
+        return int(text, 16)
+    except ValueError:
+        return None
+
+
+def parse_dump(lines, index, peripheral=None):
+    """Yield (register, value) for every register value found in the dump lines, bad values are reported"""
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        match = WORDS_LINE.match(line)
+        if match:
+            address = int(match.group(1), 16)
+            for word in match.group(2).split():
+                value = parse_hex(word)
+                if value is None:  # e.g. "Cannot access memory at address ..."
+                    print("Skipping unreadable words: %s" % line)
+                    break
+                for register in index['addresses'].get(address, []):
+                    yield register, value
+                address += 4
+            continue
+        pieces = line.replace('=', ' ').split()
+        if len(pieces) < 2:
+            continue
+        registers = lookup(index, pieces[0], peripheral)
+        value = parse_hex(pieces[1])
+        if registers and value is None:
+            print("Skipping invalid value: %s" % line)
+            continue
+        for register in registers:
+            yield register, value
+
+
+def decode(index, register, value):
+    address, size, reset, fields = index['registers'][register]
+    lines = ["%-24s 0x%08X = 0x%08X" % (register, address, value)]
+    for field, lsb, width in fields:
+        field_value = (value >> lsb) & ((1 << width) - 1)
+        bits = "[%d]" % lsb if width == 1 else "[%d:%d]" % (lsb + width - 1, lsb)
+        lines.append("    %-20s %-7s = 0x%X" % (field, bits, field_value))
+    return "\n".join(lines)
+
+
+def peripheral_range(index, peripheral):
+    registers = [index['registers'][peripheral + "." + name][0] for name in index['peripherals'][peripheral][1]]
+    return min(registers), (max(registers) - min(registers)) // 4 + 1
+
+
+def read_gdb(index, peripheral, gdb, port):
+    start, count = peripheral_range(index, peripheral)
+    cmd = [gdb, '-batch', '-ex', 'target extended-remote localhost:%d' % port, '-ex', 'x/%dwx 0x%X' % (count, start)]
+    return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True).stdout.splitlines()
+
+
+def read_openocd(index, peripheral, port):
+    """Read the peripheral through the OpenOCD Tcl server, commands and replies end with 0x1a"""
+    start, count = peripheral_range(index, peripheral)
+    with socket.create_connection(('localhost', port), timeout=10) as connection:
+        connection.sendall(('capture "mdw 0x%X %d"\x1a' % (start, count)).encode())
+        reply = b''
+        while not reply.endswith(b'\x1a'):
+            chunk = connection.recv(4096)
+            if not chunk:
+                break
+            reply += chunk
+    return reply.rstrip(b'\x1a').decode().splitlines()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Decodes STM32F746 register values into named fields.')
+    parser.add_argument('--svd', default=SVD_FILE, help="CMSIS SVD file (default: STM32F746.svd)")
+    parser.add_argument('--peripheral', help="Peripheral to list, read or to resolve bare register names in")
+    parser.add_argument('--lookup', nargs='+', default=[], help="Register names or addresses to describe")
+    parser.add_argument('--dump', help="File with register values to decode, `-` for stdin")
+    parser.add_argument('--gdb', help="GDB executable used to read --peripheral from a running GDB server")
+    parser.add_argument('--gdb-port', type=int, default=2331, help="GDB server port")
+    parser.add_argument('--openocd-port', type=int, help="OpenOCD Tcl port used to read --peripheral")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    index = load_index(args.svd)
+    peripheral = args.peripheral.upper() if args.peripheral else None
+    if peripheral is not None and peripheral not in index['peripherals']:
+        sys.exit("Unknown peripheral: %s" % peripheral)
+
+    for name in args.lookup:
+        registers = lookup(index, name, peripheral)
+        if not registers:
+            print("Unknown register: %s" % name)
+        for register in registers:
+            print(decode(index, register, index['registers'][register][2]) + "  (reset value)")
+
+    lines = None
+    if args.dump == '-':
+        lines = sys.stdin
+    elif args.dump:
+        with open(args.dump) as f:
+            lines = f.readlines()
+    elif peripheral is not None and args.gdb:
+        lines = read_gdb(index, peripheral, args.gdb, args.gdb_port)
+    elif peripheral is not None and args.openocd_port:
+        lines = read_openocd(index, peripheral, args.openocd_port)
+    elif peripheral is not None and not args.lookup:
+        base, registers = index['peripherals'][peripheral]
+        for register in registers:
+            address, size, reset, fields = index['registers'][peripheral + "." + register]
+            print("%-24s 0x%08X  (reset: 0x%08X)" % (peripheral + "." + register, address, reset))
+    if lines is not None:
+        for register, value in parse_dump(lines, index, peripheral):
+            print(decode(index, register, value))
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,20 @@ from tabulate import tabulate
 import pandas as pd
 import glob
 import re
+import time
+import hashlib
+import json
+import io
+import queue
+import shlex
+import subprocess
+import tarfile
+import tempfile
+import threading
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from functools import partial
 
 
 ################################################################################
@@ -83,6 +97,48 @@ HHC_WINDOWS = "hhc-windows"
 STM32PROGRAMMERCLI_WINDOWS = "stm32programmercli-windows"
 
 
+################################################################################
+########                       Toolchain Manifest                       ########
+################################################################################
+ARMGCC_URL = "https://developer.arm.com/open-source/gnu-toolchain/gnu-rm/downloads"
+TOOLCHAIN_URLS = {
+    ARMGCC: ARMGCC_URL,
+    ARMSIZE: ARMGCC_URL,
+    ARMGDB: ARMGCC_URL,
+    ARMGDBPY: ARMGCC_URL,
+    ASTYLE: "http://astyle.sourceforge.net",
+    CPPCHECK: "http://cppcheck.sourceforge.net",
+    OPENOCD: "http://openocd.org/getting-openocd",
+    DOXYGEN: "https://www.doxygen.nl/download.html",
+    GRAPHVIZ: "https://graphviz.org/download/",
+    PDFLATEX: "https://miktex.org/download",
+    HHC: "https://www.helpndoc.com/step-by-step-guides/how-to-download-and-install-microsofts-html-help-workshop-compiler/",
+    STM32PROGRAMMERCLI: "https://www.st.com/en/development-tools/stm32cubeprog.html",
+}
+
+# Location of each tool inside TOOLCHAIN_REPO: (repo folder, {platform: toolchain folder})
+ARMGCC_LAYOUT = ("embsw-toolchain-armgcc", {"Linux": ARMGCC_LINUX, "Darwin": ARMGCC_DARWIN, "Windows": ARMGCC_WINDOWS})
+TOOLCHAIN_LAYOUT = {
+    ARMGCC: ARMGCC_LAYOUT,
+    ARMSIZE: ARMGCC_LAYOUT,
+    ARMGDB: ARMGCC_LAYOUT,
+    ARMGDBPY: ARMGCC_LAYOUT,
+    ASTYLE: ("embsw-toolchain-astyle", {"Linux": ASTYLE_LINUX, "Darwin": ASTYLE_DARWIN, "Windows": ASTYLE_WINDOWS}),
+    CPPCHECK: ("embsw-toolchain-cppcheck", {"Linux": CPPCHECK_LINUX, "Darwin": CPPCHECK_DARWIN, "Windows": CPPCHECK_WINDOWS}),
+    OPENOCD: ("embsw-toolchain-openocd", {"Linux": OPENOCD_LINUX, "Darwin": OPENOCD_DARWIN, "Windows": OPENOCD_WINDOWS}),
+    DOXYGEN: ("embsw-toolchain-doxygen", {"Linux": DOXYGEN_LINUX, "Darwin": DOXYGEN_DARWIN, "Windows": DOXYGEN_WINDOWS}),
+    GRAPHVIZ: ("embsw-toolchain-doxygen", {"Windows": GRAPHVIZ_WINDOWS}),
+    PDFLATEX: ("embsw-toolchain-doxygen", {"Windows": PDFLATEX_WINDOWS}),
+    HHC: ("embsw-toolchain-doxygen", {"Windows": HHC_WINDOWS}),
+    STM32PROGRAMMERCLI: ("embsw-toolchain-stm32programmercli", {"Linux": STM32PROGRAMMERCLI_LINUX,
+                                                               "Darwin": STM32PROGRAMMERCLI_DARWIN,
+                                                               "Windows": STM32PROGRAMMERCLI_WINDOWS}),
+}
+TOOLCHAIN_CACHE_FILE = "build/toolchain.json"
+TOOLCHAIN_MANIFEST = None
+TOOLCHAIN_LOCK = threading.Lock()  # Guards TOOLCHAIN_MANIFEST, tasks resolve tools from ci threads
+
+
 ################################################################################
 ########                        Debug Constants                         ########
 ################################################################################
@@ -90,6 +146,7 @@ STLINK_GDB_PORT = 2331
 OPENOCD_GDB_PORT = 2331
 STLINK_TELNET_PORT = 19021
 OPENOCD_TELNET_PORT = 109021
+OPENOCD_TCL_PORT = 6666
 
 ################################################################################
 ########                        Size Parameters                         ########
@@ -182,139 +239,198 @@ JENKINS_BUILD_STAGE = "BUILD"
 JENKINS_BEAUTIFY_STAGE = "BEAUTIFY"
 JENKINS_LINT_STAGE = "LINT"
 JENKINS_TEST_STAGE = "TEST"
-JENKINS_BUILD_STAGES = [JENKINS_BUILD_STAGE, JENKINS_BEAUTIFY_STAGE, JENKINS_LINT_STAGE, JENKINS_TEST_STAGE]
+JENKINS_SIZE_STAGE = "SIZE"
+JENKINS_MAP_STAGE = "MAP"
+JENKINS_BUILD_STAGES = [JENKINS_BUILD_STAGE, JENKINS_BEAUTIFY_STAGE, JENKINS_LINT_STAGE, JENKINS_TEST_STAGE,
+                        JENKINS_SIZE_STAGE, JENKINS_MAP_STAGE]
 
+# A node of the `invoke ci` DAG: the nodes it waits for, the CPUs it keeps busy and what it runs
+CiStage = namedtuple('CiStage', 'deps cpus action')
 
-def check_exe(exe, download_url):
-    exe_path = which(exe)
-    if not exe_path:
-        msg = (
-            "Couldn't find `{}`."
-            "This tool can be found here:"
-            "> {}.".format(exe, download_url)
-        )
-        warnings.warn(msg)
 
+################################################################################
+########                        Watch Parameters                        ########
+################################################################################
+WATCH_POLL_INTERVAL = 0.5
+WATCH_DEBOUNCE = 1.0
+WATCH_DIRECTORIES = ["LCSApp", "LCSBoot", "LCSBsp", "LCSGraphics", "LCSUtils", "Drivers", "Middlewares",
+                     "USB_DEVICE", "USB_HOST", "FATFS"]
+WATCH_FILES = ["Makefile", "APP_STM32F746BGTx_FLASH.ld", "BOOT_STM32F746BGTx_FLASH.ld",
+               "app_startup_stm32f746xx.s", "boot_startup_stm32f746xx.s"]
+WATCH_EXTENSIONS = (".c", ".h", ".s", ".ld")
 
-def check_arm_toolchain():
-    """Run as a `pre` task to check for the presence of the ARM toolchains"""
-    armgcc_url = "https://developer.arm.com/open-source/gnu-toolchain/gnu-rm/downloads"
-    check_exe(ARMGCC, armgcc_url)
-    check_exe(ARMSIZE, armgcc_url)
-    check_exe(ARMGDB, armgcc_url)
 
+################################################################################
+########                        Test Parameters                         ########
+################################################################################
+TEST_DIR = "LCSAte"
+TEST_BUILD_DIR = "build/test"
+TEST_CACHE_FILE = "build/test/cache.json"
+TEST_REPORT_FILE = "build/test/junit.xml"
+TEST_FIXTURE_ENV = "LCSATE_FIXTURE"
+TEST_PROJECT_ENV = "LCSATE_PROJECT"
+TEST_FIRMWARE_ENV = "LCSATE_FIRMWARE"
+TEST_NO_TESTS_COLLECTED = 5  # pytest exit code of a suite without tests
+TEST_LOCK = threading.Lock()  # ci runs one run_test per project, they share the cache, report and fixtures
+TEST_FIXTURES = None  # (ids, queue) of the attached fixtures, detected once
 
-def check_beautify_toolchain():
-    """Run as a `pre` task to check for the presence of the ARM toolchain"""
-    beautify_url = "http://astyle.sourceforge.net"
-    check_exe(ASTYLE, beautify_url)
 
+################################################################################
+########                   Distributed Build Parameters                 ########
+################################################################################
+# Worker hosts as `host/slots,...`, `localhost` compiles in scratch folders on this machine
+BUILD_HOSTS_ENV = "LCS_BUILD_HOSTS"
+BUILD_HOST_TIMEOUT = 300
+BUILD_HOST_MAX_FAILURES = 2
 
-def check_lint_toolchain():
-    """Run as a `pre` task to check for the presence of the ARM toolchain"""
-    lint_url = "http://cppcheck.sourceforge.net"
-    check_exe(CPPCHECK, lint_url)
 
+################################################################################
+########                      Unity Build Parameters                    ########
+################################################################################
+UNITY_BUILD_DIR = "build/unity"
+UNITY_GROUPS = 8
+UNITY_SIZE_TOLERANCE = 2.0  # Percent per memory region, cross file inlining moves a few bytes
 
-def check_openocd_toolchain():
-    """Run as a `pre` task to check for the presence of the ARM toolchain"""
-    openocd_url = "http://openocd.org/getting-openocd"
-    check_exe(OPENOCD, openocd_url)
 
-    
-def check_doxygen_toolchain():
-    """Run as a `pre` task to check for the presence of the doxygen toolchain"""
-    doxygen_url = "https://www.doxygen.nl/download.html"
-    check_exe(DOXYGEN, doxygen_url)
+################################################################################
+########                          Artifact Cache                        ########
+################################################################################
+# Outside build/ so that `make clean` keeps it
+ARTIFACT_CACHE_ENV = "LCS_ARTIFACT_CACHE"
+ARTIFACT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "lcs-artifacts")
+ARTIFACT_CACHE_SIZE_ENV = "LCS_ARTIFACT_CACHE_SIZE"
+ARTIFACT_CACHE_SIZE = 2 * 1024 * 1024 * 1024
+ARTIFACT_EXTENSIONS = (".elf", ".hex", ".bin", ".map")
+# Build stamps change with every commit and build machine, a restored image keeps the stamps it was built with
+ARTIFACT_KEY_IGNORED = ("-DVERSION_BUILD_",)
 
 
-def check_graphviz_toolchain():
-    """Run as a `pre` task to check for the presence of the graphviz toolchain"""
-    graphviz_url = "https://graphviz.org/download/"
-    check_exe(GRAPHVIZ, graphviz_url)
-    
-    
-def check_miktex_toolchain():
-    """Run as a `pre` task to check for the presence of the miketex toolchain"""
-    miktex_url = "https://miktex.org/download"
-    check_exe(PDFLATEX, miktex_url)
+def check_exe(exe, download_url):
+    exe_path = which(exe)
+    if not exe_path:
+        msg = (
+            "Couldn't find `{}`."
+            "This tool can be found here:"
+            "> {}.".format(exe, download_url)
+        )
+        warnings.warn(msg)
+    return exe_path
+
+
+def toolchain_environment():
+    """Everything a resolved tool path depends on, apart from the binaries themselves"""
+    return {
+        "platform": platform.system(),
+        "path": os.environ.get("PATH", ""),
+        "toolchain_repo": os.environ.get(TOOLCHAIN_REPO_ENV, ""),
+    }
+
+
+def load_toolchain_manifest():
+    """The manifest of resolved tools, call with TOOLCHAIN_LOCK held"""
+    global TOOLCHAIN_MANIFEST
+    if TOOLCHAIN_MANIFEST is None:
+        manifest = {}
+        if os.path.isfile(TOOLCHAIN_CACHE_FILE):
+            try:
+                with open(TOOLCHAIN_CACHE_FILE) as f:
+                    manifest = json.load(f)
+            except ValueError:
+                manifest = {}
+        # A different PATH or TOOLCHAIN_REPO can resolve every tool differently
+        if manifest.get("environment") != toolchain_environment():
+            manifest = {"environment": toolchain_environment(), "tools": {}}
+        TOOLCHAIN_MANIFEST = manifest
+    return TOOLCHAIN_MANIFEST
+
+
+def save_toolchain_manifest():
+    """Replace build/toolchain.json in one step, call with TOOLCHAIN_LOCK held"""
+    os.makedirs(os.path.dirname(TOOLCHAIN_CACHE_FILE), exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=os.path.dirname(TOOLCHAIN_CACHE_FILE), prefix=".toolchain-")
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(TOOLCHAIN_MANIFEST, f, indent=1)
+        os.replace(path, TOOLCHAIN_CACHE_FILE)
+    except BaseException:
+        os.remove(path)
+        raise
+
+
+def find_tool(exe):
+    """Absolute path of a tool, from the EMBSW-TOOLCHAIN repo when TOOLCHAIN_REPO is set"""
+    if TOOLCHAIN_REPO_ENV in os.environ and exe in TOOLCHAIN_LAYOUT:
+        repo_dir, platform_dirs = TOOLCHAIN_LAYOUT[exe]
+        if platform.system() not in ("Linux", "Darwin", "Windows"):
+            msg = ("Unsupported platform !!! You are different from the crowd")
+            raise Exit(msg)
+        if platform.system() in platform_dirs:
+            return os.path.join(os.environ[TOOLCHAIN_REPO_ENV], repo_dir, platform_dirs[platform.system()], "bin", exe)
+    return check_exe(exe, TOOLCHAIN_URLS.get(exe, ""))
 
 
-def check_hhc_toolchain():
-    """Run as a `pre` task to check for the presence of the miketex toolchain"""
-    hhc_url = "https://www.helpndoc.com/step-by-step-guides/how-to-download-and-install-microsofts-html-help-workshop-compiler/"
-    check_exe(HHC, hhc_url)
-    
+def tool_version(exe_path):
+    try:
+        result = subprocess.run([exe_path, "--version"], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                text=True, timeout=30)
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+    lines = [line.strip() for line in result.stdout.splitlines() if line.strip()]
+    return lines[0] if lines else ""
+
+
+def toolchain_entry(exe):
+    """Manifest entry of a tool (path, version, sha256), probed again only when the binary changed"""
+    with TOOLCHAIN_LOCK:
+        manifest = load_toolchain_manifest()
+        entry = manifest["tools"].get(exe)
+        if entry is not None:
+            try:
+                stat = os.stat(entry["path"])
+                if [stat.st_size, stat.st_mtime_ns] == entry["stat"]:
+                    return entry
+            except (OSError, TypeError):
+                pass
+
+        exe_path = find_tool(exe)
+        exe_path = which(exe_path) if exe_path else None  # Adds .exe on Windows
+        if exe_path is None:
+            return {"path": exe, "version": "", "sha256": "", "stat": None}
+        exe_path = os.path.abspath(exe_path)
+        stat = os.stat(exe_path)
+        entry = {
+            "path": exe_path,
+            "version": tool_version(exe_path),
+            "sha256": file_sha256(exe_path),
+            "stat": [stat.st_size, stat.st_mtime_ns],
+        }
+        manifest["tools"][exe] = entry
+        save_toolchain_manifest()
+        return entry
 
-def check_stm32programmercli_toolchain():
-    """Run as a `pre` task to check for the presence of the stm32cube programmer toolchain"""
-    stm32programmercli_url = "https://www.st.com/en/development-tools/stm32cubeprog.html"
-    check_exe(STM32PROGRAMMERCLI, stm32programmercli_url)
 
-    
-def check_toolchain():
-    check_arm_toolchain()
-    check_beautify_toolchain()
-    check_lint_toolchain()
-    check_openocd_toolchain()
-    check_doxygen_toolchain()
-    check_graphviz_toolchain()
-    check_miktex_toolchain()
-    check_hhc_toolchain()
-    check_stm32programmercli_toolchain()
+def toolchain(exe):
+    """Path to run a tool with, resolved once and cached in build/toolchain.json"""
+    return toolchain_entry(exe)["path"]
+
+
+def toolchain_fingerprint(exes=(ARMGCC,)):
+    """Version and binary hash of the given tools, for caches that have to be rebuilt with the toolchain"""
+    digest = hashlib.sha256()
+    for exe in exes:
+        entry = toolchain_entry(exe)
+        digest.update("\0".join([exe, entry["version"], entry["sha256"]]).encode())
+    return digest.hexdigest()
 
 
 def check_cheetah_project():
-    global ARMGCC, ARMSIZE, ARMGDB, ARMGDBPY, ASTYLE, CPPCHECK, OPENOCD, DOXYGEN, STM32PROGRAMMERCLI, GRAPHVIZ, PDFLATEX, HHC
     if TOOLCHAIN_REPO_ENV in os.environ:
         print("Using toolchains available from EMBSW-TOOLCHAIN repo")
-        BIN = "bin"
-        TOOLCHAIN_REPO = os.environ['TOOLCHAIN_REPO']
-        ARMGCC_DIR = os.path.join(TOOLCHAIN_REPO, "embsw-toolchain-armgcc")
-        ASTYLE_DIR = os.path.join(TOOLCHAIN_REPO, "embsw-toolchain-astyle")
-        CPPCHECK_DIR = os.path.join(TOOLCHAIN_REPO, "embsw-toolchain-cppcheck")
-        OPENOCD_DIR = os.path.join(TOOLCHAIN_REPO, "embsw-toolchain-openocd")
-        DOXYGEN_DIR = os.path.join(TOOLCHAIN_REPO, "embsw-toolchain-doxygen")
-        STM32PROGRAMMERCLI_DIR = os.path.join(TOOLCHAIN_REPO, "embsw-toolchain-stm32programmercli")
-        if platform.system() == "Linux":
-            ARMGCC = os.path.join(ARMGCC_DIR, ARMGCC_LINUX, BIN, ARMGCC)
-            ARMSIZE = os.path.join(ARMGCC_DIR, ARMGCC_LINUX, BIN, ARMSIZE)
-            ARMGDB = os.path.join(ARMGCC_DIR, ARMGCC_LINUX, BIN, ARMGDB)
-            ARMGDBPY = os.path.join(ARMGCC_DIR, ARMGCC_LINUX, BIN, ARMGDBPY)
-            ASTYLE = os.path.join(ASTYLE_DIR, ASTYLE_LINUX, BIN, ASTYLE)
-            CPPCHECK = os.path.join(CPPCHECK_DIR, CPPCHECK_LINUX, BIN, CPPCHECK)
-            OPENOCD = os.path.join(OPENOCD_DIR, OPENOCD_LINUX, BIN, OPENOCD)
-            DOXYGEN = os.path.join(DOXYGEN_DIR, DOXYGEN_LINUX, BIN, DOXYGEN)
-            STM32PROGRAMMERCLI = os.path.join(STM32PROGRAMMERCLI_DIR, STM32PROGRAMMERCLI_LINUX, BIN, STM32PROGRAMMERCLI)
-        elif platform.system() == "Darwin":
-            ARMGCC = os.path.join(ARMGCC_DIR, ARMGCC_DARWIN, BIN, ARMGCC)
-            ARMSIZE = os.path.join(ARMGCC_DIR, ARMGCC_DARWIN, BIN, ARMSIZE)
-            ARMGDB = os.path.join(ARMGCC_DIR, ARMGCC_DARWIN, BIN, ARMGDB)
-            ARMGDBPY = os.path.join(ARMGCC_DIR, ARMGCC_DARWIN, BIN, ARMGDBPY)
-            ASTYLE = os.path.join(ASTYLE_DIR, ASTYLE_DARWIN, BIN, ASTYLE)
-            CPPCHECK = os.path.join(CPPCHECK_DIR, CPPCHECK_DARWIN, BIN, CPPCHECK)
-            OPENOCD = os.path.join(OPENOCD_DIR, OPENOCD_DARWIN, BIN, OPENOCD)
-            DOXYGEN = os.path.join(DOXYGEN_DIR, DOXYGEN_DARWIN, BIN, DOXYGEN)
-            STM32PROGRAMMERCLI = os.path.join(STM32PROGRAMMERCLI_DIR, STM32PROGRAMMERCLI_DARWIN, BIN, STM32PROGRAMMERCLI)
-        elif platform.system() == "Windows":
-            ARMGCC = os.path.join(ARMGCC_DIR, ARMGCC_WINDOWS, BIN, ARMGCC)
-            ARMSIZE = os.path.join(ARMGCC_DIR, ARMGCC_WINDOWS, BIN, ARMSIZE)
-            ARMGDB = os.path.join(ARMGCC_DIR, ARMGCC_WINDOWS, BIN, ARMGDB)
-            ARMGDBPY = os.path.join(ARMGCC_DIR, ARMGCC_WINDOWS, BIN, ARMGDBPY)
-            ASTYLE = os.path.join(ASTYLE_DIR, ASTYLE_WINDOWS, BIN, ASTYLE)
-            CPPCHECK = os.path.join(CPPCHECK_DIR, CPPCHECK_WINDOWS, BIN, CPPCHECK)
-            OPENOCD = os.path.join(OPENOCD_DIR, OPENOCD_WINDOWS, BIN, OPENOCD)
-            DOXYGEN = os.path.join(DOXYGEN_DIR, DOXYGEN_WINDOWS, BIN, DOXYGEN)
-            GRAPHVIZ = os.path.join(DOXYGEN_DIR, GRAPHVIZ_WINDOWS, BIN, GRAPHVIZ)
-            PDFLATEX = os.path.join(DOXYGEN_DIR, PDFLATEX_WINDOWS, BIN, PDFLATEX)
-            HHC = os.path.join(DOXYGEN_DIR, HHC_WINDOWS, BIN, HHC)
-            STM32PROGRAMMERCLI = os.path.join(STM32PROGRAMMERCLI_DIR, STM32PROGRAMMERCLI_WINDOWS, BIN, STM32PROGRAMMERCLI)
-        else:
+        if platform.system() not in ("Linux", "Darwin", "Windows"):
             msg = ("Unsupported platform !!! You are different from the crowd")
             raise Exit(msg)
     else:
         print("Hopefully you have added following toolchains to your PATH environment variable")
-        check_toolchain()
 
 def check_legacy_project():
     pass
@@ -358,8 +474,286 @@ def run_make(ctx, project, parallel=False, thread=8):
         ctx.run(cmd)
 
 
-def run_clean(ctx):
-    ctx.run("make clean")
+def run_clean(ctx, project=None):
+    if project is None:
+        ctx.run("make clean")
+    else:
+        for build_dir in (f'build/{project}', f'{UNITY_BUILD_DIR}/{project}'):
+            if os.path.isdir(build_dir):
+                shutil.rmtree(build_dir)
+
+
+def run_clean_cache(project=None):
+    for used, size, cached_project, entry in artifact_entries(artifact_cache_dir()):
+        if project is None or cached_project == project:
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def compile_commands(ctx, project, always=False):
+    """The C compile commands `make` would run for the project, all of them with `always`"""
+    result = ctx.run(f'make -n {"-B " if always else ""}{project}', hide=True, warn=True)
+    commands = []
+    for line in result.stdout.splitlines():
+        try:
+            argv = shlex.split(line)
+        except ValueError:
+            continue
+        if argv and argv[0].endswith("gcc") and "-c" in argv and "-x" not in argv \
+                and any(arg.endswith(".c") for arg in argv):
+            commands.append(argv)
+    return commands
+
+
+def compile_outputs(argv):
+    """Files a compile command writes: the object, the -MMD dependency file and the assembler listing"""
+    outputs = []
+    for index, arg in enumerate(argv):
+        if arg in ("-o", "-MF"):
+            outputs.append(argv[index + 1])
+        elif arg.startswith("-MF"):
+            outputs.append(arg[3:])
+        elif arg.startswith("-Wa,"):
+            outputs += [option.split("=", 1)[1] for option in arg.split(",")[1:]
+                        if option.startswith("-a") and "=" in option]
+    return outputs
+
+
+def dependency_scan(argv):
+    """Source and headers a compile command reads as `-MM` lists them, None when the scan fails
+
+    Toolchain headers are not listed, they are covered by the toolchain itself.
+    """
+    scan = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg in ("-o", "-MF", "-MT", "-MQ"):
+            skip = True
+        elif arg not in ("-c", "-MMD", "-MD", "-MP") and not arg.startswith(("-MF", "-Wa,")):
+            scan.append(arg)
+    try:
+        result = subprocess.run(scan + ["-MM"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    if result.returncode != 0:
+        return None
+    rule = result.stdout.replace("\\\n", " ")
+    return rule.split(":", 1)[1].split() if ":" in rule else []  # Plain assembler has no dependencies
+
+
+def compile_inputs(argv):
+    """Source and project headers of a compile command, from a local dependency scan
+
+    None when the scan fails or a file lies outside the project tree, such a
+    file can not be shipped to the same relative path on a worker. Toolchain
+    headers are not listed (-MM), every worker has its own copy.
+    """
+    inputs = dependency_scan(argv)
+    if inputs is None:
+        return None
+    for path in inputs:
+        if os.path.isabs(path) or os.path.normpath(path).startswith(".."):
+            return None
+    return inputs
+
+
+def pack_files(paths):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as archive:
+        for path in paths:
+            archive.add(path, arcname=path.replace(os.sep, "/"), recursive=False)
+    return buffer.getvalue()
+
+
+def unpack_files(data, paths):
+    """Content of the given paths in a gzipped tar archive, KeyError when one is missing"""
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as archive:
+        for path in paths:
+            files[path] = archive.extractfile(path.replace(os.sep, "/")).read()
+    return files
+
+
+def working_directory():
+    """The folder gcc records as DW_AT_comp_dir, it prefers $PWD over the resolved path"""
+    pwd = os.environ.get("PWD")
+    if pwd and os.path.isdir(pwd) and os.path.samefile(pwd, os.getcwd()):
+        return pwd
+    return os.getcwd()
+
+
+class LocalTransport:
+    """Worker stand-in, compiles in a scratch folder on this machine exactly like a remote host would"""
+
+    def __init__(self, name, slots, project_dir):
+        self.name = name
+        self.slots = slots
+        self.project_dir = project_dir
+
+    def compile(self, argv, archive, outputs):
+        with tempfile.TemporaryDirectory() as scratch:
+            scratch = os.path.realpath(scratch)
+            with tarfile.open(fileobj=io.BytesIO(archive), mode="r:gz") as files:
+                files.extractall(scratch)
+            for output in outputs:
+                os.makedirs(os.path.join(scratch, os.path.dirname(output)), exist_ok=True)
+            # Debug info has to name the project folder, not the scratch folder
+            cmd = argv + [f'-fdebug-prefix-map={scratch}={self.project_dir}']
+            result = subprocess.run(cmd, cwd=scratch, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                    text=True, timeout=BUILD_HOST_TIMEOUT)
+            if result.returncode != 0:
+                raise RuntimeError(result.stderr)
+            files = {}
+            for output in outputs:
+                with open(os.path.join(scratch, output), 'rb') as f:
+                    files[output] = f.read()
+            return result.stderr, files
+
+
+class SshTransport:
+    """Worker host reached over ssh, the inputs go in on stdin and the outputs come back on stdout"""
+
+    def __init__(self, name, slots, project_dir, toolchain_dir, compiler_version):
+        self.name = name
+        self.slots = slots
+        self.project_dir = project_dir
+        self.toolchain_dir = toolchain_dir
+        self.compiler_version = compiler_version
+
+    def compile(self, argv, archive, outputs):
+        compiler = shlex.quote(argv[0])
+        folders = " ".join(shlex.quote(os.path.dirname(output) or ".") for output in outputs)
+        # A different compiler release can not produce the same objects, the worker refuses the job
+        script = (
+            f'[ "$({compiler} --version | head -n 1)" = {shlex.quote(self.compiler_version)} ] || exit 125; '
+            f'd=$(mktemp -d) && cd "$d" && tar xzf - && mkdir -p {folders} && '
+            f'{" ".join(shlex.quote(arg) for arg in argv)} '
+            f'-fdebug-prefix-map="$d"={shlex.quote(self.project_dir)} '
+            f'-fdebug-prefix-map="$(dirname "$(dirname "$(command -v {compiler})")")"={shlex.quote(self.toolchain_dir)} '
+            f'>&2 && tar czf - {" ".join(shlex.quote(output) for output in outputs)}; '
+            f'status=$?; cd / && rm -rf "$d"; exit $status'
+        )
+        result = subprocess.run(["ssh", "-o", "BatchMode=yes", self.name, script], input=archive,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=BUILD_HOST_TIMEOUT)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.decode(errors="replace"))
+        return result.stderr.decode(errors="replace"), unpack_files(result.stdout, outputs)
+
+
+class CompileScheduler:
+    """Hands every compile to the worker expected to finish it first
+
+    The estimate is the running average compile time of the worker times its
+    queue depth per slot. A worker is dropped after BUILD_HOST_MAX_FAILURES
+    failures that a local compile of the same file did not reproduce.
+    """
+
+    def __init__(self, transports):
+        self.transports = transports
+        self.condition = threading.Condition()
+        self.in_flight = dict((transport.name, 0) for transport in transports)
+        self.seconds = dict((transport.name, 1.0) for transport in transports)
+        self.failures = dict((transport.name, 0) for transport in transports)
+        self.compiled = dict((transport.name, 0) for transport in transports)
+        self.fallbacks = 0
+
+    def acquire(self):
+        """The worker for the next compile, None when no worker is left"""
+        with self.condition:
+            while True:
+                usable = [t for t in self.transports if self.failures[t.name] < BUILD_HOST_MAX_FAILURES]
+                if not usable:
+                    return None
+                free = [t for t in usable if self.in_flight[t.name] < t.slots]
+                if free:
+                    transport = min(free, key=lambda t: (self.in_flight[t.name] + 1) * self.seconds[t.name] / t.slots)
+                    self.in_flight[transport.name] += 1
+                    return transport
+                self.condition.wait()
+
+    def release(self, transport, seconds=None, failed=False):
+        with self.condition:
+            self.in_flight[transport.name] -= 1
+            if failed:
+                self.failures[transport.name] += 1
+            elif seconds is not None:
+                self.compiled[transport.name] += 1
+                self.seconds[transport.name] = 0.8 * self.seconds[transport.name] + 0.2 * seconds
+            self.condition.notify_all()
+
+
+def distributed_compile(scheduler, local_slots, argv):
+    """Compile on a worker, or locally when no worker can take it or the worker fails"""
+    source = next(arg for arg in argv if arg.endswith(".c"))
+    outputs = compile_outputs(argv)
+    for output in outputs:
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    inputs = compile_inputs(argv)
+    transport = scheduler.acquire() if inputs is not None else None
+    if transport is not None:
+        start = time.time()
+        try:
+            diagnostics, files = transport.compile(argv, pack_files(inputs), outputs)
+        except (OSError, RuntimeError, KeyError, tarfile.TarError, subprocess.SubprocessError) as error:
+            print(f'WORKER FAILED: {transport.name} {source}\n{str(error).strip()}')
+        else:
+            scheduler.release(transport, seconds=time.time() - start)
+            for output, data in files.items():
+                with open(output, 'wb') as f:
+                    f.write(data)
+            print(f'CC [{transport.name}] {source}\n{diagnostics}'.rstrip())
+            return True
+
+    with local_slots:
+        result = subprocess.run(argv, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if transport is not None:
+        # A compile error fails locally as well, that is not the worker's fault
+        scheduler.release(transport, failed=result.returncode == 0)
+    with scheduler.condition:
+        scheduler.fallbacks += 1
+    print(f'CC [local] {source}\n{result.stdout}'.rstrip())
+    return result.returncode == 0
+
+
+def build_transports(hosts, project_dir, compiler):
+    """Transports for `host/slots,...`, slots default to the CPU count of this machine"""
+    compiler_path = which(compiler) or compiler
+    toolchain_dir = os.path.dirname(os.path.dirname(os.path.abspath(compiler_path)))
+    transports = []
+    for spec in hosts.split(","):
+        name, _, slots = spec.strip().partition("/")
+        if not name:
+            continue
+        slots = int(slots) if slots else (os.cpu_count() or 1)
+        if name == "localhost":
+            transports.append(LocalTransport(name, slots, project_dir))
+        else:
+            transports.append(SshTransport(name, slots, project_dir, toolchain_dir, tool_version(compiler_path)))
+    return transports
+
+
+def run_distributed_build(ctx, project, hosts, thread=8):
+    """Fan the C compiles out to the worker hosts, then let make assemble, link and convert"""
+    commands = compile_commands(ctx, project)
+    if commands:
+        transports = build_transports(hosts, working_directory(), commands[0][0])
+        if not transports:
+            raise Exit(f'No worker host in "{hosts}"')
+        scheduler = CompileScheduler(transports)
+        local_slots = threading.BoundedSemaphore(thread)
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=sum(transport.slots for transport in transports)) as executor:
+            results = list(executor.map(lambda argv: distributed_compile(scheduler, local_slots, argv), commands))
+        print(f'\nCompiled {len(commands)} files in {time.time() - start:.1f} s')
+        for transport in transports:
+            print(f'  {transport.name}: {scheduler.compiled[transport.name]} files, '
+                  f'{scheduler.seconds[transport.name]:.2f} s average'
+                  + (' (dropped)' if scheduler.failures[transport.name] >= BUILD_HOST_MAX_FAILURES else ''))
+        print(f'  local: {scheduler.fallbacks} files')
+        if not all(results):
+            raise Exit('Build failed : ' + project)
+    run_make(ctx=ctx, project=project, thread=thread)
         
 
 def run_size(ctx, project):
@@ -428,7 +822,7 @@ def run_size(ctx, project):
         return
     
     # Find FLASH & RAM size
-    cmd = f'{ARMSIZE} -l {project_path}' 
+    cmd = f'{toolchain(ARMSIZE)} -l {project_path}' 
     output = ctx.run(cmd, hide= 'out') #hide= 'out' used to hide the stdout data in invoke frame work
     
     print("")
@@ -492,7 +886,7 @@ def run_doxygen(ctx, project):
         return
   
     #run doxyfile
-    cmd = f'{DOXYGEN} {doxyfile_path}' 
+    cmd = f'{toolchain(DOXYGEN)} {doxyfile_path}' 
     ctx.run(cmd) 
     
     #make chm file path
@@ -500,7 +894,7 @@ def run_doxygen(ctx, project):
     
     #make chm file
     with ctx.cd(chm_file_path):
-        ctx.run(f'{HHC} index.hhp')
+        ctx.run(f'{toolchain(HHC)} index.hhp')
     
     #remove unwanted files in latex folder
     chm_file_path = project + "/Doxygen/html/*.*" 
@@ -513,7 +907,7 @@ def run_doxygen(ctx, project):
     
     #make pdf file
     with ctx.cd(pdf_file_path):
-        ctx.run(f'{PDFLATEX} refman.tex')
+        ctx.run(f'{toolchain(PDFLATEX)} refman.tex')
     
     #remove unwanted files in latex folder
     pdf_file_path = project + "/Doxygen/latex/*.*" 
@@ -532,22 +926,22 @@ def run_doxygen(ctx, project):
 def run_astyle(ctx, project, check=False):
     if check:
         if project != BOOTLOADER:
-            cmd = f'{ASTYLE} --options=astyle_c.options.txt --recursive --dry-run --errors-to-stdout LCSApp/{project}/*.c,*.h'
+            cmd = f'{toolchain(ASTYLE)} --options=astyle_c.options.txt --recursive --dry-run --errors-to-stdout LCSApp/{project}/*.c,*.h'
         elif project == BOOTLOADER:
-            cmd = f'{ASTYLE} --options=astyle_c.options.txt --recursive --dry-run --errors-to-stdout LCSBoot/*.c,*.h'
+            cmd = f'{toolchain(ASTYLE)} --options=astyle_c.options.txt --recursive --dry-run --errors-to-stdout LCSBoot/*.c,*.h'
     else:
         if project != BOOTLOADER:
-            cmd = f'{ASTYLE} --options=astyle_c.options.txt --recursive --formatted LCSApp/{project}/*.c,*.h'
+            cmd = f'{toolchain(ASTYLE)} --options=astyle_c.options.txt --recursive --formatted LCSApp/{project}/*.c,*.h'
         elif project == BOOTLOADER:
-            cmd = f'{ASTYLE} --options=astyle_c.options.txt --recursive --formatted LCSBoot/*.c,*.h'
+            cmd = f'{toolchain(ASTYLE)} --options=astyle_c.options.txt --recursive --formatted LCSBoot/*.c,*.h'
     ctx.run(cmd)
 
 
 def run_cppcheck(ctx, project):
-    if project == LOADER or project == EXCAVATOR:
-        cmd = f'{CPPCHECK} --force LCSApp/{project}/' #--addon=misra.py
+    if project != BOOTLOADER:
+        cmd = f'{toolchain(CPPCHECK)} --force LCSApp/{project}/' #--addon=misra.py
     elif project == BOOTLOADER:
-        cmd = f'{CPPCHECK} --force LCSBoot/' #--addon=misra.py
+        cmd = f'{toolchain(CPPCHECK)} --force LCSBoot/' #--addon=misra.py
     ctx.run(cmd)
 
 
@@ -589,7 +983,7 @@ def run_flash(ctx, project, interface="swd", config=None, exl=False):
             EXTERNAL_LOADER_ADDRESS = BOOTLOADER_QSPI_START_ADDRESS
 
         external_command = EXTERNAL_LOADER_ADDRESS + " -el STM32F746.stldr"
-        cmd = f'{STM32PROGRAMMERCLI} {command} -w {elf_file_path} {external_command}'
+        cmd = f'{toolchain(STM32PROGRAMMERCLI)} {command} -w {elf_file_path} {external_command}'
     else:
         # Fetch starting address
         if project == LOADER:
@@ -604,25 +998,825 @@ def run_flash(ctx, project, interface="swd", config=None, exl=False):
             STARTING_ADDRESS = GTRUCK_APP_START_ADDRESS
         elif project == BOOTLOADER:
             STARTING_ADDRESS = BOOTLOADER_APP_START_ADDRESS
-        cmd = f'{STM32PROGRAMMERCLI} {command} -w {elf_file_path} {STARTING_ADDRESS}'
+        cmd = f'{toolchain(STM32PROGRAMMERCLI)} {command} -w {elf_file_path} {STARTING_ADDRESS}'
 
     #stm32cube programmer cli interface   
     ctx.run(cmd)
 
 
-def run_map(ctx, project, combine=False):
+def run_map(ctx, project, combine=False, regions=False):
+    options = ""
     if combine is True:
-        cmd = f'python analyze_map.py --combine build/{project}/{project}.map'
-    else:
-        cmd = f'python analyze_map.py build/{project}/{project}.map'
+        options += " --combine"
+    if regions is True:
+        options += " --regions"
+    cmd = f'python analyze_map.py{options} build/{project}/{project}.map'
+    ctx.run(cmd)
+
+
+def run_map_export(ctx, projects, export, output=None):
+    # All the projects go through one process so they end up in one file
+    map_files = " ".join(f'build/{project}/{project}.map' for project in projects)
+    options = f' --format {export}'
+    if output is not None:
+        options += f' --output {output}'
+    cmd = f'python analyze_map.py{options} {map_files}'
+    ctx.run(cmd)
+
+
+def run_assets(ctx, projects, min_size=None, similarity=None):
+    # All the projects go through one process so duplicates across projects are found
+    elf_files = " ".join(f'build/{project}/{project}.elf' for project in projects)
+    options = ""
+    if min_size is not None:
+        options += f' --min-size {min_size}'
+    if similarity is not None:
+        options += f' --similarity {similarity}'
+    cmd = f'python analyze_assets.py{options} {elf_files}'
+    ctx.run(cmd)
+
+
+def run_placement(ctx, project, itcm=None, dtcm=None, quadspi=None, hot=None, output=None):
+    options = ""
+    if itcm is not None:
+        options += f' --itcm {itcm}'
+    if dtcm is not None:
+        options += f' --dtcm {dtcm}'
+    if quadspi is not None:
+        options += f' --quadspi {quadspi}'
+    if hot is not None:
+        options += f' --hot {hot}'
+    if output is not None:
+        options += f' --output {output}'
+    cmd = f'python advise_placement.py{options} build/{project}/{project}.map'
     ctx.run(cmd)
 
 
-def run_test(ctx, project):
-    cmd = f'Pytest -v LCSAte/gpio/test_gpio.py -s'
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def hash_files(paths):
+    """sha256 over the content of the given files, missing files hash as empty"""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode())
+        if os.path.isfile(path):
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+
+def support_files(project):
+    """Every python file a suite of the project can import: LCSAte without the other projects' folders"""
+    files = []
+    for path in sorted(glob.glob(os.path.join(TEST_DIR, "**", "*.py"), recursive=True)):
+        folder = os.path.relpath(path, TEST_DIR).split(os.sep)[0]
+        if folder in SUPPORTED_PROJECTS and folder != project:
+            continue
+        files.append(path)
+    return files
+
+
+def discover_test_suites(project):
+    """Suites of the project's own folder under LCSAte plus the shared peripheral folders"""
+    return [path for path in support_files(project) if re.match(r'test_.*\.py$', os.path.basename(path))]
+
+
+def detect_test_fixtures(ctx):
+    """Serial numbers of the attached ST-LINK test fixtures"""
+    output = ctx.run(f'{toolchain(STM32PROGRAMMERCLI)} -l st-link', hide=True, warn=True)
+    if output is None or not output.ok:
+        return []
+    return re.findall(r'ST-LINK SN\s*:\s*(\w+)', output.stdout)
+
+
+def fixture_pool(ctx, workers=None):
+    """The fixture ids and a queue handing them out, attached fixtures are shared by concurrent runs"""
+    global TEST_FIXTURES
+    with TEST_LOCK:
+        if TEST_FIXTURES is None:
+            fixture_ids = detect_test_fixtures(ctx)
+            TEST_FIXTURES = (fixture_ids, queue.Queue())
+            for fixture in fixture_ids:
+                TEST_FIXTURES[1].put(fixture)
+    if TEST_FIXTURES[0]:
+        return TEST_FIXTURES
+
+    # No hardware attached, every worker gets a simulated fixture
+    fixture_ids = [f'sim{index}' for index in range(int(workers or os.cpu_count() or 1))]
+    fixtures = queue.Queue()
+    for fixture in fixture_ids:
+        fixtures.put(fixture)
+    return fixture_ids, fixtures
+
+
+def run_test_suite(project, suite, fixtures, report):
+    fixture = fixtures.get()
+    try:
+        env = dict(os.environ)
+        env[TEST_FIXTURE_ENV] = fixture
+        env[TEST_PROJECT_ENV] = project
+        env[TEST_FIRMWARE_ENV] = "build/" + project + "/" + project + ".elf"
+        cmd = [sys.executable, "-m", "pytest", "-v", suite, f"--junitxml={report}",
+               "-o", f"junit_suite_name={project}.{os.path.splitext(os.path.basename(suite))[0]}"]
+        result = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        print(f'TESTED: {project} {suite} on {fixture}\n{result.stdout}')
+        return result.returncode
+    finally:
+        fixtures.put(fixture)
+
+
+def merge_junit_reports(reports, merged_report, projects):
+    """Replace the suites of the projects in the merged report, the other projects keep their last results"""
+    root = ET.Element("testsuites")
+    if os.path.isfile(merged_report):
+        for suite in ET.parse(merged_report).getroot():
+            if suite.get("name", "").split(".")[0] not in projects:
+                root.append(suite)
+    for report in reports:
+        if not os.path.isfile(report):
+            continue
+        tree = ET.parse(report).getroot()
+        suites = [tree] if tree.tag == "testsuite" else list(tree)
+        root.extend(suites)
+    for attribute in ("tests", "failures", "errors", "skipped"):
+        root.set(attribute, str(sum(int(suite.get(attribute, 0)) for suite in root)))
+    ET.ElementTree(root).write(merged_report, encoding="utf-8", xml_declaration=True)
+
+
+def run_regs(ctx, peripheral=None, lookup=None, dump=None, gdb=False, openocd=False):
+    options = ""
+    if peripheral is not None:
+        options += f' --peripheral {peripheral}'
+    if lookup is not None:
+        options += f' --lookup {lookup}'
+    if dump is not None:
+        options += f' --dump {dump}'
+    elif gdb:
+        options += f' --gdb {toolchain(ARMGDBPY)} --gdb-port {STLINK_GDB_PORT}'
+    elif openocd:
+        options += f' --openocd-port {OPENOCD_TCL_PORT}'
+    cmd = f'python decode_registers.py{options}'
     ctx.run(cmd)
 
 
+def run_test(ctx, projects, workers=None, force=False):
+    os.makedirs(TEST_BUILD_DIR, exist_ok=True)
+    fixture_ids, fixtures = fixture_pool(ctx, workers)
+
+    cache = {}
+    with TEST_LOCK:
+        if os.path.isfile(TEST_CACHE_FILE) and not force:
+            with open(TEST_CACHE_FILE) as f:
+                cache = json.load(f)
+
+    jobs = []
+    reports = []
+    for project in projects:
+        firmware = "build/" + project + "/" + project + ".elf"
+        inputs = hash_files([firmware] + support_files(project))
+        for suite in discover_test_suites(project):
+            key = hashlib.sha256((inputs + suite).encode()).hexdigest()
+            report = os.path.join(TEST_BUILD_DIR, key + ".xml")
+            reports.append(report)
+            if cache.get(project + ":" + suite) == key and os.path.isfile(report):
+                print(f'UNCHANGED: {project} {suite}')
+                continue
+            jobs.append((project, suite, key, report))
+
+    failed = False
+    empty = []
+    results = {}  # project:suite -> key, None when it failed
+    with ThreadPoolExecutor(max_workers=len(fixture_ids)) as executor:
+        futures = [(job, executor.submit(run_test_suite, job[0], job[1], fixtures, job[3])) for job in jobs]
+        for (project, suite, key, report), future in futures:
+            returncode = future.result()
+            if returncode in (0, TEST_NO_TESTS_COLLECTED):
+                results[project + ":" + suite] = key
+                if returncode == TEST_NO_TESTS_COLLECTED:
+                    empty.append(f'{project} {suite}')
+            else:
+                results[project + ":" + suite] = None
+                failed = True
+
+    with TEST_LOCK:
+        # Another project may have saved its results since this run read the cache
+        cache = {}
+        if os.path.isfile(TEST_CACHE_FILE):
+            with open(TEST_CACHE_FILE) as f:
+                cache = json.load(f)
+        for name, key in results.items():
+            if key is None:
+                cache.pop(name, None)
+            else:
+                cache[name] = key
+        with open(TEST_CACHE_FILE, 'w') as f:
+            json.dump(cache, f, indent=1)
+        merge_junit_reports(reports, TEST_REPORT_FILE, projects)
+    print(f'Test report: {TEST_REPORT_FILE}')
+    for suite in empty:
+        print(f'NO TESTS: {suite}')
+    if failed:
+        raise Exit("Some tests failed")
+
+
+MACRO_DEFINITION = re.compile(r'^\s*#\s*define\s+(\w+)', re.M)
+MACRO_UNDEFINITION = re.compile(r'^\s*#\s*undef\s+(\w+)', re.M)
+C_COMMENT_OR_LITERAL = re.compile(r'//[^\n]*|/\*.*?\*/|"(?:\\.|[^"\\\n])*"|\'(?:\\.|[^\'\\\n])*\'', re.S)
+C_DIRECTIVE = re.compile(r'^\s*#(?:[^\n]*\\\n)*[^\n]*', re.M)
+C_IDENTIFIER = re.compile(r'\b[A-Za-z_]\w*')
+C_TOKEN = re.compile(r'\w+|\S')
+C_TAGS = ("struct", "union", "enum")
+
+
+def split_tokens(tokens, separator):
+    """Split a token list at the separator outside of parentheses, brackets and braces"""
+    parts = [[]]
+    depth = 0
+    for token in tokens:
+        if token in ("(", "[", "{"):
+            depth += 1
+        elif token in (")", "]", "}"):
+            depth -= 1
+        elif token == separator and depth == 0:
+            parts.append([])
+            continue
+        parts[-1].append(token)
+    return parts
+
+
+def declarator_name(tokens):
+    """The name a declarator introduces, None for a bare struct/union/enum"""
+    kept = []
+    index = 0
+    while index < len(tokens):
+        if tokens[index] in ("__attribute__", "__asm__", "asm", "["):
+            # Attributes, asm labels and array sizes do not name anything
+            index += tokens[index] != "["
+            depth = 0
+            while index < len(tokens):
+                depth += tokens[index] in ("(", "[")
+                depth -= tokens[index] in (")", "]")
+                index += 1
+                if depth == 0:
+                    break
+            continue
+        kept.append(tokens[index])
+        index += 1
+    if not kept or kept[-1] == "}":
+        return None
+    if "(" in kept:
+        start = kept.index("(")
+        if start + 1 < len(kept) and kept[start + 1] == "*":  # Pointer to a function or an array
+            kept = kept[start + 1:kept.index(")", start)]
+        else:
+            kept = kept[:start]
+    names = [index for index, token in enumerate(kept) if C_IDENTIFIER.match(token)]
+    if not names or (names[-1] and kept[names[-1] - 1] in C_TAGS):
+        return None
+    return kept[names[-1]]
+
+
+def add_declaration(tokens, local, external):
+    """Sort the names of one file-scope declaration into file local and external ones"""
+    for index in range(len(tokens) - 2):
+        if tokens[index] in C_TAGS and tokens[index + 2] == "{":
+            local.add(tokens[index] + " " + tokens[index + 1])
+    names = local if "static" in tokens or "typedef" in tokens else external
+    for declarator in split_tokens(tokens, ","):
+        name = declarator_name(split_tokens(declarator, "=")[0])
+        if name is not None:
+            names.add(name)
+
+
+def file_scope_names(source):
+    """(local, external, macros, used) names of a C file, included headers are not scanned
+
+    Local are the static functions and variables, typedefs, tags and enum
+    constants of the file, external every other name it declares at file
+    scope. Macros are the ones the file leaves defined and used every
+    identifier it mentions, comments and literals left out.
+    """
+    with open(source, errors="replace") as f:
+        text = C_COMMENT_OR_LITERAL.sub(" ", f.read())
+    macros = set(MACRO_DEFINITION.findall(text)) - set(MACRO_UNDEFINITION.findall(text))
+    local = set()
+    external = set()
+    declaration = []
+    depth = 0
+    for match in C_TOKEN.finditer(C_DIRECTIVE.sub(" ", text)):
+        token = match.group()
+        if depth:
+            depth += (token == "{") - (token == "}")
+            if token == "{" or depth:
+                body.append(token)
+            elif not function:
+                if "enum" in declaration[-2:]:
+                    local.update(part[0] for part in split_tokens(body, ",") if part)
+                declaration += ["{", "}"]
+        elif token == "{":
+            depth = 1
+            body = []
+            function = bool(declaration) and declaration[-1] == ")"
+            if function:
+                add_declaration(declaration, local, external)
+                declaration = []
+        elif token == ";":
+            add_declaration(declaration, local, external)
+            declaration = []
+        else:
+            declaration.append(token)
+    return local, external, macros, set(C_IDENTIFIER.findall(text))
+
+
+def unity_clashes(unit, names):
+    """{file of the unit: names} that break when a file with these names is appended to the unit"""
+    local, external, macros, used = names
+    clashes = {}
+    for name in sorted(local & (set(unit["local"]) | set(unit["external"]))):
+        clashes.setdefault(unit["local"].get(name) or unit["external"][name], []).append(name)
+    for name in sorted(external & set(unit["local"])):
+        clashes.setdefault(unit["local"][name], []).append(name)
+    for name in sorted(used & set(unit["macros"])):
+        clashes.setdefault(unit["macros"][name], []).append(name)
+    return clashes
+
+
+def unity_groups(sources, groups=UNITY_GROUPS):
+    """Split the sources into at most `groups` units of similar size, in Makefile order
+
+    A file clashes with a unit when a file-local name of one is declared by
+    the other, or when it uses a macro an earlier file of the unit defines.
+    It then goes to the smallest unit it does not clash with, or is compiled
+    on its own. Returns the units, the files compiled on their own and the
+    collisions.
+    """
+    target = sum(os.path.getsize(source) for source in sources) / max(groups, 1)
+    units = []
+    deferred = []
+    collisions = []
+    for source in sources:
+        if not units or (units[-1]["size"] >= target and len(units) < groups):
+            units.append({"sources": [], "local": {}, "external": {}, "macros": {}, "size": 0})
+        names = file_scope_names(source)
+        clashes = unity_clashes(units[-1], names)
+        if clashes:
+            collisions += [(source, other, clash) for other, clash in sorted(clashes.items())]
+            deferred.append((source, names))
+            continue
+        add_to_unit(units[-1], source, names)
+
+    solo = []
+    for source, names in deferred:
+        for unit in sorted(units, key=lambda unit: unit["size"]):
+            if not unity_clashes(unit, names):
+                add_to_unit(unit, source, names)
+                break
+        else:
+            solo.append(source)
+    return [unit["sources"] for unit in units if unit["sources"]], solo, collisions
+
+
+def add_to_unit(unit, source, names):
+    local, external, macros, used = names
+    unit["sources"].append(source)
+    unit["local"].update(dict.fromkeys(local, source))
+    unit["external"].update(dict.fromkeys(external, source))
+    unit["macros"].update(dict.fromkeys(macros, source))
+    unit["size"] += os.path.getsize(source)
+
+
+def write_unity_sources(directory, units):
+    """One unity_<n>.c per unit, files are only rewritten when their content changes"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for index, unit in enumerate(units):
+        path = f'{directory}/unity_{index}.c'
+        lines = ["/* Generated by `invoke unity`, do not edit */"]
+        lines += [f'#include "{os.path.relpath(source, directory)}"'.replace(os.sep, "/") for source in unit]
+        content = "\n".join(lines) + "\n"
+        if not os.path.isfile(path) or open(path).read() != content:
+            with open(path, 'w') as f:
+                f.write(content)
+        paths.append(path)
+    for path in glob.glob(f'{directory}/unity_*.c'):
+        if path.replace(os.sep, "/") not in paths:
+            os.remove(path)  # Left over from a run with more groups
+    return paths
+
+
+def print_size_comparison(normal_map, unity_map, tolerance):
+    """Print the region usage of both builds, returning the regions that differ by more than tolerance %"""
+    import analyze_map
+    normal = analyze_map.MapFile(normal_map).region_usage()
+    unity = analyze_map.MapFile(unity_map).region_usage()
+    rows = []
+    mismatched = []
+    for region, used in normal.items():
+        delta = unity.get(region, 0) - used
+        rows.append([region, str(used), str(unity.get(region, 0)), "{:+d}".format(delta)])
+        if abs(delta) * 100 > tolerance * used:
+            mismatched.append(region)
+    print(tabulate(rows, headers=["Region", "Normal", "Unity", "Delta"], tablefmt='fancy_grid'))
+    return mismatched
+
+
+def run_unity(ctx, project, groups=UNITY_GROUPS, listings=False, compare=False, tolerance=UNITY_SIZE_TOLERANCE,
+              thread=8):
+    sources = [next(arg for arg in argv if arg.endswith(".c")) for argv in compile_commands(ctx, project, True)]
+    if not sources:
+        raise Exit(f'No C sources found for {project}')
+    unity_dir = f'{UNITY_BUILD_DIR}/{project}'
+    units, solo, collisions = unity_groups(sources, groups)
+    for source, other, names in collisions:
+        print(f'COLLISION: {source} clashes with {other} on {", ".join(names)}')
+    for source in solo:
+        print(f'SEPARATE: {source}')
+    unity_sources = write_unity_sources(unity_dir, units) + solo
+    print(f'{len(sources)} files in {len(units)} unity units and {len(solo)} separate files')
+
+    normal_seconds = None
+    if compare:
+        start = time.time()
+        ctx.run(f'make -B -j{thread} {project}')
+        normal_seconds = time.time() - start
+    options = f'BUILD_DIR={unity_dir} C_SOURCES="{" ".join(unity_sources)}"'
+    if not listings:
+        options += ' LISTING='
+    start = time.time()
+    ctx.run(f'make {"-B " if compare else ""}-j{thread} {project} {options}')
+    unity_seconds = time.time() - start
+
+    if normal_seconds is not None:
+        print(f'Normal build: {normal_seconds:.1f} s, unity build: {unity_seconds:.1f} s, '
+              f'speedup: x{normal_seconds / unity_seconds:.2f}')
+    normal_map = f'build/{project}/{project}.map'
+    if not os.path.isfile(normal_map):
+        print(f'No normal build to compare the image size with ({normal_map})')
+        return
+    mismatched = print_size_comparison(normal_map, f'{unity_dir}/{project}.map', float(tolerance))
+    if mismatched:
+        raise Exit(f'Unity image of {project} differs by more than {tolerance}% in {", ".join(mismatched)}')
+
+
+def ci_stages(ctx, projects, stages, jobs, cache=False):
+    """The pipeline DAG as {node: CiStage}, builds first so the long chains start early
+
+    Build and test nodes take `jobs` CPUs, a test node runs that many
+    simulated fixtures when no hardware is attached.
+    """
+    nodes = {}
+    for project in projects:
+        if JENKINS_BUILD_STAGE in stages:
+            name = f'{JENKINS_BUILD_STAGE}:{project}'
+            action = partial(run_make, ctx=ctx, project=project, thread=jobs)
+            if cache:
+                action = partial(run_cached_build, ctx=ctx, project=project, build=action)
+            nodes[name] = CiStage([], jobs, action)
+    for project in projects:
+        if JENKINS_LINT_STAGE in stages:
+            nodes[f'{JENKINS_LINT_STAGE}:{project}'] = CiStage([], 1, partial(run_cppcheck, ctx=ctx, project=project))
+        if JENKINS_BEAUTIFY_STAGE in stages:
+            nodes[f'{JENKINS_BEAUTIFY_STAGE}:{project}'] = CiStage(
+                [], 1, partial(run_astyle, ctx=ctx, project=project, check=True))
+    for project in projects:
+        built = [f'{JENKINS_BUILD_STAGE}:{project}'] if JENKINS_BUILD_STAGE in stages else []
+        if JENKINS_SIZE_STAGE in stages:
+            nodes[f'{JENKINS_SIZE_STAGE}:{project}'] = CiStage(built, 1, partial(run_size, ctx=ctx, project=project))
+        if JENKINS_MAP_STAGE in stages:
+            nodes[f'{JENKINS_MAP_STAGE}:{project}'] = CiStage(built, 1, partial(run_map, ctx=ctx, project=project))
+        if JENKINS_TEST_STAGE in stages:
+            nodes[f'{JENKINS_TEST_STAGE}:{project}'] = CiStage(
+                built, jobs, partial(run_test, ctx=ctx, projects=[project], workers=jobs))
+    return nodes
+
+
+def critical_path(nodes, finished):
+    """The chain that ended the pipeline, following the dependency that finished last"""
+    if not finished:
+        return []
+    path = [max(finished, key=finished.get)]
+    while True:
+        dependencies = [dependency for dependency in nodes[path[-1]].deps if dependency in finished]
+        if not dependencies:
+            return path[::-1]
+        path.append(max(dependencies, key=finished.get))
+
+
+def print_ci_timing(nodes, status, started, finished, pipeline_start):
+    path = critical_path(nodes, finished)
+    rows = []
+    for name in sorted(nodes, key=lambda name: started.get(name, float('inf'))):
+        if name in started:
+            rows.append([name, status[name], "%.1f" % (started[name] - pipeline_start),
+                         "%.1f" % (finished[name] - started[name]), "*" if name in path else ""])
+        else:
+            rows.append([name, status[name], "", "", ""])
+    print(tabulate(rows, headers=["Stage", "Status", "Start [s]", "Duration [s]", "Critical"], tablefmt='fancy_grid'))
+    if path:
+        print("Critical path: " + " -> ".join(f'{name} ({finished[name] - started[name]:.1f} s)' for name in path))
+    print(f'Pipeline: {time.time() - pipeline_start:.1f} s')
+
+
+def run_ci(ctx, projects, stages=JENKINS_BUILD_STAGES, cpus=None, keep_going=False, cache=False):
+    """Run the pipeline nodes as soon as their dependencies passed and the CPU budget allows
+
+    A node needing more CPUs than the budget runs alone. Without keep_going
+    no node is started after the first failure, the running ones finish.
+    """
+    cpus = int(cpus or os.cpu_count() or 1)
+    nodes = ci_stages(ctx, projects, stages, jobs=max(1, cpus // 2), cache=cache)
+    status = {}
+    started = {}
+    finished = {}
+    running = {}  # future -> node
+    used = 0
+    pipeline_start = time.time()
+    with ThreadPoolExecutor(max_workers=max(len(nodes), 1)) as executor:
+        while True:
+            if keep_going or "failed" not in status.values():
+                for name, node in nodes.items():
+                    if name in status or name in running.values():
+                        continue
+                    if any(status.get(dependency) in ("failed", "skipped") for dependency in node.deps):
+                        status[name] = "skipped"
+                        continue
+                    if any(status.get(dependency) != "passed" for dependency in node.deps):
+                        continue
+                    if used and used + node.cpus > cpus:
+                        continue
+                    print(f'STAGE: {name}')
+                    started[name] = time.time()
+                    running[executor.submit(node.action)] = name
+                    used += node.cpus
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                used -= nodes[name].cpus
+                finished[name] = time.time()
+                try:
+                    future.result()
+                    status[name] = "passed"
+                except Exception as error:  # Exit, UnexpectedExit or a bug in a stage, the pipeline goes on
+                    status[name] = "failed"
+                    print(f'STAGE FAILED: {name}\n{error}')
+    for name in nodes:
+        status.setdefault(name, "skipped")
+
+    print("")
+    print_ci_timing(nodes, status, started, finished, pipeline_start)
+    failed = [name for name in nodes if status[name] == "failed"]
+    if failed:
+        raise Exit("CI failed: " + ", ".join(failed))
+
+
+def artifact_cache_dir():
+    return os.environ.get(ARTIFACT_CACHE_ENV, ARTIFACT_CACHE_DIR)
+
+
+def artifact_inputs(ctx, project):
+    """The commands of a full build of the project, the files they read and the compiler they run
+
+    The headers are the ones `-MM` finds for each compile command, the same
+    set the -MMD dependency files of the build will list. None when make or
+    a scan fails, or when the compiler is not found.
+    """
+    result = ctx.run(f'make -n -B {project}', hide=True, warn=True)
+    if not result.ok:
+        return None
+    commands = []
+    compiles = []
+    files = {"Makefile"}
+    for line in result.stdout.splitlines():
+        try:
+            argv = shlex.split(line)
+        except ValueError:
+            argv = line.split()
+        if "-c" in argv:
+            compiles.append(argv)
+        argv = [arg for arg in argv if not arg.startswith(ARTIFACT_KEY_IGNORED)]
+        commands.append(" ".join(argv))
+        for arg in argv:
+            if arg.endswith((".c", ".s")) and os.path.isfile(arg):
+                files.add(arg)
+            elif arg.startswith("-T"):
+                files.add(arg[2:])
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as executor:
+        for inputs in executor.map(dependency_scan, compiles):
+            if inputs is None:
+                return None
+            files.update(inputs)
+    # make runs $(PREFIX)gcc from PATH or GCC_PATH, which need not be the TOOLCHAIN_REPO compiler
+    compiler = which(compiles[0][0]) if compiles else None
+    if compiler is None:
+        return None
+    return commands, sorted(files), os.path.abspath(compiler)
+
+
+def artifact_key(ctx, project):
+    """Content address of the project image: build commands, input files and toolchain"""
+    inputs = artifact_inputs(ctx, project)
+    if inputs is None:
+        return None
+    commands, files, compiler = inputs
+    digest = hashlib.sha256()
+    digest.update("\n".join([project] + commands).encode())
+    digest.update(hash_files(files).encode())
+    digest.update(toolchain_fingerprint([compiler]).encode())
+    return digest.hexdigest()
+
+
+def restore_artifacts(project, key, cache_dir):
+    """Copy a cached image into build/<project>, False on a miss or a damaged entry"""
+    entry = os.path.join(cache_dir, key[:2], key)
+    manifest_path = os.path.join(entry, "manifest.json")
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        damaged = [name for name, sha256 in manifest["files"].items()
+                   if file_sha256(os.path.join(entry, name)) != sha256]
+    except (OSError, ValueError, KeyError, AttributeError):
+        damaged = None if not os.path.isdir(entry) else ["manifest.json"]
+    if damaged is None:
+        return False
+    if damaged:
+        print(f'DAMAGED: {entry} ({", ".join(damaged)}), building {project}')
+        shutil.rmtree(entry, ignore_errors=True)
+        return False
+    build_dir = f'build/{project}'
+    os.makedirs(build_dir, exist_ok=True)
+    for name in manifest["files"]:
+        shutil.copyfile(os.path.join(entry, name), os.path.join(build_dir, name))
+    os.utime(manifest_path)  # Recently used, evicted last
+    return True
+
+
+def store_artifacts(project, key, cache_dir, max_size=ARTIFACT_CACHE_SIZE):
+    build_dir = f'build/{project}'
+    names = [project + extension for extension in ARTIFACT_EXTENSIONS]
+    entry = os.path.join(cache_dir, key[:2], key)
+    if os.path.isdir(entry) or not all(os.path.isfile(os.path.join(build_dir, name)) for name in names):
+        return
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    # Staged next to the entry and renamed into place, a reader never sees half an entry
+    staging = tempfile.mkdtemp(dir=cache_dir, prefix=".staging-")
+    manifest = {"project": project, "key": key, "files": {}}
+    for name in names:
+        shutil.copyfile(os.path.join(build_dir, name), os.path.join(staging, name))
+        manifest["files"][name] = file_sha256(os.path.join(staging, name))
+    with open(os.path.join(staging, "manifest.json"), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    try:
+        os.rename(staging, entry)
+    except OSError:
+        shutil.rmtree(staging, ignore_errors=True)  # Stored meanwhile by a concurrent build
+    evict_artifacts(cache_dir, max_size)
+
+
+def artifact_entries(cache_dir):
+    """(last use, size, project, entry folder) of every cached image"""
+    entries = []
+    for manifest_path in glob.glob(os.path.join(cache_dir, "*", "*", "manifest.json")):
+        entry = os.path.dirname(manifest_path)
+        try:
+            with open(manifest_path) as f:
+                project = json.load(f).get("project")
+            size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+            entries.append((os.stat(manifest_path).st_mtime, size, project, entry))
+        except (OSError, ValueError, AttributeError):
+            continue  # Removed or being written by another build
+    return entries
+
+
+def evict_artifacts(cache_dir, max_size=ARTIFACT_CACHE_SIZE):
+    """Remove the least recently used images until the cache fits in max_size bytes"""
+    entries = sorted(artifact_entries(cache_dir))
+    total = sum(entry[1] for entry in entries)
+    for used, size, project, entry in entries:
+        if total <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+
+
+def run_cached_build(ctx, project, build):
+    """Restore the project image from the artifact cache, or run `build` and store its image"""
+    cache_dir = artifact_cache_dir()
+    key = artifact_key(ctx, project)
+    if key is not None and restore_artifacts(project, key, cache_dir):
+        print(f'CACHED: {project} ({key[:12]})')
+        return
+    build()
+    if key is not None:
+        store_artifacts(project, key, cache_dir, int(os.environ.get(ARTIFACT_CACHE_SIZE_ENV, ARTIFACT_CACHE_SIZE)))
+
+
+def snapshot_sources(path=ROOT_DIR):
+    """Modification time of every file a build depends on, keyed by path"""
+    snapshot = {}
+    for name in WATCH_FILES:
+        file_path = os.path.join(path, name)
+        if os.path.isfile(file_path):
+            snapshot[file_path] = os.stat(file_path).st_mtime_ns
+    pending = [os.path.join(path, name) for name in WATCH_DIRECTORIES]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.name.endswith(WATCH_EXTENSIONS):
+                    snapshot[entry.path] = entry.stat().st_mtime_ns
+    return snapshot
+
+
+def wait_for_change(snapshot, interval=WATCH_POLL_INTERVAL, debounce=WATCH_DEBOUNCE):
+    """Poll until the sources change and then stay quiet for `debounce` seconds"""
+    while True:
+        time.sleep(interval)
+        current = snapshot_sources()
+        if current != snapshot:
+            break
+    # Editors save in bursts, wait for the last write before building
+    while True:
+        time.sleep(debounce)
+        latest = snapshot_sources()
+        if latest == current:
+            break
+        current = latest
+    changed = [path for path in current if current[path] != snapshot.get(path)]
+    changed += [path for path in snapshot if path not in current]
+    return current, changed
+
+
+def print_map_delta(previous, current):
+    """Print the regions and objects whose size changed between two parsed map files
+
+    The first build has nothing to compare against and prints the full region usage instead.
+    """
+    previous_usage = previous.region_usage() if previous else {}
+    rows = []
+    for region, used in current.region_usage().items():
+        origin, length = current.regions[region]
+        delta = used - previous_usage.get(region, 0)
+        if previous is None or delta:
+            rows.append([region, str(used), "{:+d}".format(delta), percentage_calculation(used, length)])
+
+    sources = set(previous.size_by_source) | set(current.size_by_source) if previous else set()
+    changed = []
+    for source in sorted(sources):
+        before = previous.size_by_source.get(source)
+        after = current.size_by_source.get(source)
+        before_total = before.total() if before else 0
+        after_total = after.total() if after else 0
+        if before_total != after_total:
+            changed.append("%-40s \t%+7d  (code: %+d data: %+d)" % (os.path.normpath(source),
+                           after_total - before_total,
+                           (after.code if after else 0) - (before.code if before else 0),
+                           (after.data if after else 0) - (before.data if before else 0)))
+
+    if not rows and not changed:
+        print("No size change")
+        return
+    if rows:
+        print(tabulate(rows, headers=["Region", "Used", "Delta", "Usage"], tablefmt='fancy_grid'))
+    for line in changed:
+        print(line)
+
+
+def run_watch(ctx, project, thread=8, interval=WATCH_POLL_INTERVAL, debounce=WATCH_DEBOUNCE):
+    import analyze_map
+
+    map_file_path = "build/" + project + "/" + project + ".map"
+    previous = None
+    snapshot = snapshot_sources()
+    changed = []
+    while True:
+        result = ctx.run(f'make -j{thread} {project}', warn=True)
+        if result.ok and os.path.isfile(map_file_path):
+            current = analyze_map.MapFile(map_file_path)
+            print("")
+            print_map_delta(previous, current)
+            previous = current
+        else:
+            print('\nBuild failed : ' + project + '\n')
+        print(f'Watching {project} for changes (Ctrl+C to stop)')
+        snapshot, changed = wait_for_change(snapshot, interval=interval, debounce=debounce)
+        for path in changed:
+            print('CHANGED: ' + os.path.relpath(path, ROOT_DIR))
+
+
 def percentage_calculation(size=None, max_size=None):
     if size is None or max_size is None:
         raise ValueError("ValueError exception thrown")
@@ -666,25 +1860,64 @@ def move_and_rename_doxygen_files(project=None, folder_name=None, file_name=None
 
 
 @task(help={
-    "project" : "The project to build (same as folder name)"
+    "project" : "The project to build (same as folder name)",
+    "hosts" : "Worker hosts to compile on as `host/slots,...`, `localhost` compiles in local scratch folders "
+              "(default: $LCS_BUILD_HOSTS, none builds with make only)",
+    "cache" : "Restore the image from the artifact cache when no input changed, store it after a build",
 })
-def build(ctx, project=None):
-    """Build all/specific project"""
+def build(ctx, project=None, hosts=None, cache=False):
+    """Build all/specific project
+
+    With worker hosts the C files are compiled on the workers over ssh, each
+    gets its source and project headers, the objects come back byte identical
+    to a local build. A file a worker fails on is compiled locally.
+
+    With the cache the .elf/.hex/.bin/.map are looked up by a hash of the
+    build commands, sources, headers, linker script and toolchain, in
+    $LCS_ARTIFACT_CACHE (~/.cache/lcs-artifacts by default).
+
+    Examples:
+        $ invoke build --project=<project_name>
+        $ invoke build -p loader --hosts=localhost/4,buildbox/16
+        $ invoke build -p all --cache
+    """
     check_project(project=project)
-    if project.lower() == "all":
-        for project in SUPPORTED_PROJECTS:
-            run_make(ctx=ctx, project=project)
-    else:
-        run_make(ctx=ctx, project=project)
+    hosts = hosts or os.environ.get(BUILD_HOSTS_ENV)
+    projects = SUPPORTED_PROJECTS if project.lower() == "all" else [project]
+    for project in projects:
+        if hosts:
+            action = partial(run_distributed_build, ctx=ctx, project=project, hosts=hosts)
+        else:
+            action = partial(run_make, ctx=ctx, project=project)
+        if cache:
+            run_cached_build(ctx=ctx, project=project, build=action)
+        else:
+            action()
 
 
 @task(help={
-    "project" : "The project to clean (same as folder name)"
+    "project" : "The project to clean (same as folder name)",
+    "cache" : "Also drop the project images kept in the artifact cache",
 })
-def clean(ctx, project=None):
-    """Clean all/specific project"""
+def clean(ctx, project=None, cache=False):
+    """Clean all/specific project
+
+    Only build/<project> is removed for a single project, `all` removes the
+    whole build folder. The artifact cache is kept unless --cache is given.
+
+    Examples:
+        $ invoke clean --project=<project_name>
+        $ invoke clean -p all --cache
+    """
     check_project(project=project)
-    run_clean(ctx=ctx)
+    if project.lower() == "all":
+        run_clean(ctx=ctx)
+        if cache:
+            run_clean_cache()
+    else:
+        run_clean(ctx=ctx, project=project)
+        if cache:
+            run_clean_cache(project=project)
 
 
 @task(help={
@@ -783,40 +2016,198 @@ def flash(ctx, project=None, interface=None, config=None, exl=False):
 
 @task(help={
     "project" : "The project to map using GNU linker file (same as folder name)",
+    "regions" : "Break the sizes down per memory region, including .bss, .noinit and heap/stack",
+    "export" : "Export symbol level sizes as jsonl, csv or html (treemap) instead of printing them",
+    "output" : "File to write the export to (default: stdout)",
 })
-def map(ctx, project=None, combine=False):
+def map(ctx, project=None, combine=False, regions=False, export=None, output=None):
     """To map the source code using GNU linker file
 
     Examples:
         $ invoke map --project=<project_name>
+        $ invoke map --project=<project_name> --regions
+        $ invoke map -p all --export=html --output=size.html
+    """
+    check_project(project=project)
+    if export is not None:
+        projects = SUPPORTED_PROJECTS if project.lower() == "all" else [project]
+        run_map_export(ctx=ctx, projects=projects, export=export, output=output)
+    elif project.lower() == "all":
+        for project in SUPPORTED_PROJECTS:
+            run_map(ctx=ctx, project=project, combine=combine, regions=regions)
+    else:
+        run_map(ctx=ctx, project=project, combine=combine, regions=regions)
+
+
+@task(help={
+    "project" : "The project to look for duplicated constant data in, `all` compares every project",
+    "min_size" : "Ignore constants smaller than this many bytes (64 by default)",
+    "similarity" : "Share of content two constants need in common to be near duplicates (0.5 by default)",
+})
+def assets(ctx, project=None, min_size=None, similarity=None):
+    """Find duplicated LVGL images, fonts and constant tables and estimate re-encoding savings
+
+    Examples:
+        $ invoke assets --project=<project_name>
+        $ invoke assets -p all --min-size=1024
+    """
+    check_project(project=project)
+    if project.lower() == "all":
+        run_assets(ctx=ctx, projects=SUPPORTED_PROJECTS, min_size=min_size, similarity=similarity)
+    else:
+        run_assets(ctx=ctx, projects=[project], min_size=min_size, similarity=similarity)
+
+
+@task(help={
+    "project" : "The project to suggest ITCM/DTCM/QUADSPI placement for (same as folder name)",
+    "itcm" : "ITCM budget in bytes for hot code (16K by default)",
+    "dtcm" : "DTCM budget in bytes for hot constant data (none by default)",
+    "quadspi" : "QUADSPI budget in bytes for cold sections (free QUADSPI space by default)",
+    "hot" : "Hot function list, `function [samples]` per line, e.g. exported from a profiler",
+    "output" : "File to write the linker script snippets to",
+})
+def placement(ctx, project=None, itcm=None, dtcm=None, quadspi=None, hot=None, output=None):
+    """Suggest the input sections to move into ITCM, DTCM or QUADSPI using the map file
+
+    Examples:
+        $ invoke placement --project=<project_name>
+        $ invoke placement -p loader --hot=profile.txt --dtcm=8192 --output=placement.ld
     """
     check_project(project=project)
     if project.lower() == "all":
         for project in SUPPORTED_PROJECTS:
-            run_map(ctx=ctx, project=project, combine=combine)
+            run_placement(ctx=ctx, project=project, itcm=itcm, dtcm=dtcm, quadspi=quadspi, hot=hot, output=output)
     else:
-        run_map(ctx=ctx, project=project, combine=combine)
+        run_placement(ctx=ctx, project=project, itcm=itcm, dtcm=dtcm, quadspi=quadspi, hot=hot, output=output)
+
+
+@task(help={
+    "peripheral" : "The peripheral to list, read from the target or resolve register names in (e.g. GPIOA)",
+    "lookup" : "Register name (GPIOA.MODER) or address (0x40020000) to describe",
+    "dump" : "File with register values to decode (`NAME value`, `address value` or `address: words...`)",
+    "gdb" : "Read the peripheral from the running GDB server",
+    "openocd" : "Read the peripheral through the running OpenOCD",
+})
+def regs(ctx, peripheral=None, lookup=None, dump=None, gdb=False, openocd=False):
+    """Decode STM32F746 register values into named fields using STM32F746.svd
+
+    The SVD is indexed into build/svd_index.pickle on the first run.
+
+    Examples:
+        $ invoke regs --peripheral=GPIOA
+        $ invoke regs --lookup=RCC.CR
+        $ invoke regs --peripheral=GPIOA --dump=gpioa.txt
+        $ invoke regs --peripheral=USART1 --gdb
+    """
+    if (gdb or openocd) and peripheral is None:
+        raise Exit("Please mention the peripheral to read from the target")
+    run_regs(ctx=ctx, peripheral=peripheral, lookup=lookup, dump=dump, gdb=gdb, openocd=openocd)
 
 
 @task(help={
     "project" : "The project peripherals add to be test",
+    "workers" : "Number of simulated fixtures when no test fixture is attached (CPU count by default)",
+    "force" : "Run every suite, even the ones that passed with the same firmware and test sources",
 })
-def test(ctx, project=None):
+def test(ctx, project=None, workers=None, force=False):
     """The selected project peripherals add to be test
 
+    Suites under LCSAte are sharded across the attached test fixtures and
+    merged into build/test/junit.xml. Suites that passed with the same
+    firmware image and test sources are not run again.
+
     Examples:
         $ invoke test --project=<project_name>
+        $ invoke test -p all --workers=4
     """
     check_project(project=project)
     if project.lower() == "all":
-        for project in SUPPORTED_PROJECTS:
-            run_test(ctx=ctx, project=project)
+        run_test(ctx=ctx, projects=SUPPORTED_PROJECTS, workers=workers, force=force)
     else:
-        run_test(ctx=ctx, project=project)
+        run_test(ctx=ctx, projects=[project], workers=workers, force=force)
+
+
+
+@task(help={
+    "project" : "The project to run the pipeline for, `all` puts every project in one DAG",
+    "stages" : "Comma separated Jenkins stages to run (all by default): " + ",".join(JENKINS_BUILD_STAGES),
+    "cpus" : "CPU budget of the concurrent stages, a build takes half of it (CPU count by default)",
+    "keep_going" : "Keep starting the stages that do not depend on a failed one",
+    "cache" : "Restore unchanged project images from the artifact cache instead of building them",
+})
+def ci(ctx, project=None, stages=None, cpus=None, keep_going=False, cache=False):
+    """Run the Jenkins stages as a dependency DAG and print the stage timing and critical path
+
+    BEAUTIFY (check only) and LINT do not wait for BUILD, SIZE, MAP and TEST
+    do. Stages that are ready run concurrently within the CPU budget.
+
+    Examples:
+        $ invoke ci --project=<project_name>
+        $ invoke ci -p all --cpus=16 --keep-going --cache
+        $ invoke ci -p loader --stages=BUILD,SIZE
+    """
+    check_project(project=project)
+    projects = SUPPORTED_PROJECTS if project.lower() == "all" else [project]
+    selected = JENKINS_BUILD_STAGES
+    if stages is not None:
+        selected = [stage.strip().upper() for stage in stages.split(",") if stage.strip()]
+        unknown = [stage for stage in selected if stage not in JENKINS_BUILD_STAGES]
+        if unknown:
+            raise Exit(f'Unknown stages: {unknown}\nList of stages: {JENKINS_BUILD_STAGES}')
+    run_ci(ctx=ctx, projects=projects, stages=selected, cpus=cpus, keep_going=keep_going, cache=cache)
+
+
+@task(help={
+    "project" : "The project to build from unity translation units (same as folder name)",
+    "groups" : "Number of unity translation units the C files are split into (8 by default)",
+    "listings" : "Write the assembler listing of every unity unit",
+    "compare" : "Rebuild the normal and the unity build from scratch and report the speedup",
+    "tolerance" : "Allowed size difference per memory region against the normal build, in percent",
+})
+def unity(ctx, project=None, groups=UNITY_GROUPS, listings=False, compare=False, tolerance=UNITY_SIZE_TOLERANCE):
+    """Build the project from a few generated unity translation units into build/unity
+
+    The C files of the Makefile are #included into `groups` unity_<n>.c files
+    so the HAL and CMSIS headers are parsed once per unit. Files defining the
+    same file-local name, or using a macro an earlier file defines, are kept
+    in different units. The image size is checked against
+    build/<project>/<project>.map.
+
+    Examples:
+        $ invoke unity --project=<project_name>
+        $ invoke unity -p loader --groups=4 --compare
+    """
+    check_project(project=project)
+    projects = SUPPORTED_PROJECTS if project.lower() == "all" else [project]
+    for project in projects:
+        run_unity(ctx=ctx, project=project, groups=int(groups), listings=listings, compare=compare,
+                  tolerance=float(tolerance))
+
+
+@task(help={
+    "project" : "The project to rebuild on every change (same as folder name)",
+    "interval" : "Seconds between two polls of the source tree",
+    "debounce" : "Seconds the source tree has to stay unchanged before rebuilding",
+})
+def watch(ctx, project=None, interval=WATCH_POLL_INTERVAL, debounce=WATCH_DEBOUNCE):
+    """Rebuild the project on every change and print the size deltas
+
+    Examples:
+        $ invoke watch --project=<project_name>
+        $ invoke watch -p loader --debounce=2
+    """
+    check_project(project=project)
+    if project.lower() == "all":
+        raise Exit("Please mention a single project to watch")
+    try:
+        run_watch(ctx=ctx, project=project, interval=float(interval), debounce=float(debounce))
+    except KeyboardInterrupt:
+        print("")
+
 
-    
 # Add all tasks to the namespace
-ns = Collection(build, clean, beautify, lint, size, doxygen, flash, map, test)
+ns = Collection(build, clean, beautify, lint, size, doxygen, flash, map, placement, assets, regs, test, unity, ci,
+                watch)
 # Configure every task to act as a shell command
 #   (will print colors, allow interactive CLI)
 # Add our extra configuration file for the project